@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""Benchmark the data pipeline on synthetic participants.
+
+    python bin/benchmark.py                          # 10, 1000 and 10000 participants
+    python bin/benchmark.py --sizes 1000 --save before.json
+    # ... edit preprocessing.py ...
+    python bin/benchmark.py --sizes 1000 --compare before.json
+
+Each size gets a fresh SQLite database in a temporary directory, which is
+also where the data is written, so your data/ folder and participants.db are
+never touched. Peak memory is measured with tracemalloc, which slows
+everything down; use --no-memory for cleaner timings.
+"""
+
+import os
+import sys
+import json
+import importlib
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from contextlib import contextmanager, redirect_stdout
+
+VERSION = 'benchmark'
+
+# ---------- synthetic participants ---------- #
+
+def synthetic_events(rng, n_tasks=4, n_rounds=5, mousemove_hz=30):
+    """An event log shaped like what setup.js and task.js record.
+
+    The first task is practice (during instructions), the rest are the main
+    block. While a target is up, the mouse position is recorded mousemove_hz
+    times per second.
+    """
+    events = []
+    points = 0
+    t = 1_600_000_000_000 + rng.randrange(10 ** 10)
+    def record(event, **data):
+        data['timestamp'] = t
+        data['event'] = event
+        events.append(data)
+
+    def task(k):
+        nonlocal t, points
+        uid = f'task-{k}'
+        timeout = rng.choice([1000, 2000, 3000])
+        record('task.run', uniqueID=uid)
+        record('task.initialize', uniqueID=uid, targetSize=20, timeout=timeout, nRound=n_rounds,
+               delayRange=[500, 1000], screenWidth=600, screenHeight=400)
+        record('task.countdown', uniqueID=uid)
+        t += 3000
+        outcome = 'win'
+        for _ in range(n_rounds):
+            t += rng.randrange(500, 1000)
+            record('task.setTarget', uniqueID=uid, x=rng.uniform(20, 580), y=rng.uniform(20, 380))
+            rt = rng.uniform(200, timeout * 1.2)
+            for _ in range(int(min(rt, timeout) / 1000 * mousemove_hz)):
+                t += int(1000 / mousemove_hz)
+                record('task.mousemove', uniqueID=uid, x=rng.uniform(0, 600), y=rng.uniform(0, 400))
+            if rt >= timeout:
+                record('task.timeout', uniqueID=uid)
+                outcome = 'lose'
+            elif rng.random() < 0.8:
+                record('task.hit', uniqueID=uid, x=rng.uniform(0, 600), y=rng.uniform(0, 400))
+                points += 10
+                record('bonus.addPoints', points=10, total=points)
+            else:
+                record('task.miss', uniqueID=uid, x=rng.uniform(0, 600), y=rng.uniform(0, 400))
+                outcome = 'lose'
+            if outcome == 'lose':
+                t += 1000
+                break
+        record('task.outcome', uniqueID=uid, outcome=outcome)
+        record('task.done', uniqueID=uid, result=outcome)
+
+    record('experiment.initialize', CONDITION=rng.randrange(6), PARAMS={'foo': 'bar'})
+    record('experiment.begin', timestring='12:00:00 GMT-0400 (Eastern Daylight Time)')
+    record('timeline.start.instructions')
+    task(0)
+    t += 5000
+    record('timeline.end.instructions')
+    record('timeline.start.main')
+    for k in range(1, n_tasks):
+        task(k)
+        record('data.attempt')
+        record('data.success')
+    record('timeline.end.main')
+    record('timeline.start.survey')
+    t += 60000
+    record('survey.done', uniqueID='survey-0', results={'age': rng.randrange(18, 80), 'gender': 'prefer not to say'})
+    record('timeline.end.survey')
+    record('timeline.start.debrief')
+    t += 20000
+    record('debrief.submitted', difficulty=rng.choice(['too easy', 'just right', 'too hard']),
+           feedback=rng.choice(['', 'fun!', 'the targets were too small']))
+    record('timeline.end.debrief')
+    record('experiment.complete')
+    return events
+
+def synthetic_datastring(i, rng, **kwargs):
+    """A psiturk datastring for participant i, as saved by /sync_delta."""
+    workerid, assignmentid = f'w{i}', f'a{i}'
+    events = synthetic_events(rng, **kwargs)
+    return {
+        'condition': i % 6, 'counterbalance': 0,
+        'assignmentId': assignmentid, 'workerId': workerid, 'hitId': 'prolific',
+        'currenttrial': len(events), 'useragent': 'Mozilla/5.0 (benchmark)',
+        'data': [{
+            'uniqueid': f'{workerid}:{assignmentid}', 'current_trial': j,
+            'dateTime': e['timestamp'], 'trialdata': e,
+        } for j, e in enumerate(events)],
+        'questiondata': {'params': {'foo': 'bar'}, 'bonus': round(rng.uniform(0, 2), 2)},
+        'eventdata': [{'eventtype': 'focus', 'value': 'on', 'interval': 0, 'timestamp': events[0]['timestamp']}],
+    }
+
+def populate(n, seed=0, compress=False, **kwargs):
+    """Insert n synthetic participants, returning the total number of events."""
+    from datetime import datetime
+    from psiturk.db import engine, init_db
+    from psiturk.models import Participant
+    import datastore
+    init_db()
+    rng = random.Random(seed)
+    n_events = 0
+    batch = []
+    def flush():
+        with engine.begin() as conn:
+            conn.execute(Participant.__table__.insert(), batch)
+        batch.clear()
+    for i in range(n):
+        data = synthetic_datastring(i, rng, **kwargs)
+        n_events += len(data['data'])
+        batch.append({
+            'uniqueid': f'w{i}:a{i}', 'assignmentid': f'a{i}', 'workerid': f'w{i}',
+            'hitid': 'prolific', 'ipaddress': '127.0.0.1', 'cond': i % 6, 'counterbalance': 0,
+            'codeversion': VERSION, 'beginhit': datetime.now(), 'status': 3, 'mode': 'live',
+            'datastring': datastore.encode(json.dumps(data), compress),
+        })
+        if len(batch) == 100:
+            flush()
+    if batch:
+        flush()
+    return n_events
+
+# ---------- measurement ---------- #
+
+@contextmanager
+def measure(results, stage, n, n_events, memory=True):
+    result = {'stage': stage, 'participants': n, 'events': n_events, 'peak_mb': None}
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as quiet, redirect_stdout(quiet):
+        yield result
+    result['seconds'] = time.perf_counter() - start
+    if memory:
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    results.append(result)
+    print_result(result)
+
+class PerParticipant:
+    """Times stages that run once per participant, adding them up over participants.
+
+    Peak memory is the most allocated during any one run of the stage, so it
+    includes whatever the loop holds for the current participant, but nothing
+    from earlier ones.
+    """
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.seconds = defaultdict(float)
+        self.peak_mb = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        if self.memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        self.seconds[name] += time.perf_counter() - start
+        if self.memory:
+            self.peak_mb[name] = max(self.peak_mb[name], tracemalloc.get_traced_memory()[1] / 1e6)
+
+    def results(self, n, n_events):
+        return [{'stage': stage, 'participants': n, 'events': n_events, 'seconds': seconds,
+                 'peak_mb': self.peak_mb[stage] if self.memory else None}
+                for stage, seconds in self.seconds.items()]
+
+def print_result(r, baseline=None):
+    line = (f"{r['stage']:24} {r['participants']:>7} {r['seconds']:9.3f}s "
+            f"{r['participants'] / r['seconds']:10.1f} ppt/s {r['events'] / r['seconds']:12.0f} ev/s")
+    if r['peak_mb'] is not None:
+        line += f" {r['peak_mb']:9.1f} MB"
+    if baseline:
+        line += f"   {baseline['seconds'] / r['seconds']:.2f}x vs before"
+    print(line, flush=True)
+
+# ---------- stages ---------- #
+
+def run_size(n, args, auth):
+    import fetch_data
+    import preprocessing
+    from psiturk.experiment import app
+    results = []
+    memory = not args.no_memory
+    print(f'\n{n} participants')
+
+    with measure(results, 'populate database', n, 0, memory) as result:
+        n_events = result['events'] = populate(
+            n, args.seed, args.compress, n_tasks=args.tasks, n_rounds=args.rounds,
+            mousemove_hz=args.mousemove_hz)
+    print(f'  ({n_events} events, {n_events / n:.0f} per participant)')
+
+    with measure(results, 'write_data', n, n_events, memory):
+        fetch_data.write_data(VERSION, 'local', jsonl=args.jsonl)
+
+    # one participant at a time, as process_data does
+    methods = fetch_data.parse_methods()
+    queries = []  # what the parsers actually ask find_events for
+    for method in methods:
+        parser = getattr(preprocessing.DataProcessor, method)
+        queries.extend([parser._query] if hasattr(parser, '_query') else getattr(parser, '_reads', ()))
+    files = sorted(f'data/raw/{VERSION}/events/{f}' for f in os.listdir(f'data/raw/{VERSION}/events'))
+    timer = PerParticipant(memory)
+    if memory:
+        tracemalloc.start()
+    with open(os.devnull, 'w') as quiet, redirect_stdout(quiet):
+        for f in files:
+            with timer.stage('load events'):
+                p = preprocessing.DataProcessor.load(f)
+            with timer.stage('find_events (index)'):
+                p._index
+            with timer.stage('find_events (queries)'):
+                for query in queries:
+                    p.find_events(query)
+            rows = {}
+            for method in methods:
+                with timer.stage(f'parser: {method}'):
+                    rows[method] = p.parse([method])[method]
+            with timer.stage('write_csv'):
+                for method, data in rows.items():
+                    if getattr(preprocessing.DataProcessor, method)._parser == 'csv':
+                        fetch_data.write_csv(os.devnull, data)
+            del p, rows
+    if memory:
+        tracemalloc.stop()
+    for result in timer.results(n, n_events):
+        results.append(result)
+        print_result(result)
+
+    with measure(results, 'process_data', n, n_events, memory):
+        fetch_data.process_data(VERSION, args.jobs, use_cache=False)
+
+    client = app.test_client()
+    with measure(results, 'download_datafiles', n, n_events, memory):
+        for name in ['trialdata', 'eventdata', 'questiondata']:
+            response = client.get(f'/data/{VERSION}/{name}', headers=auth)
+            assert response.status_code == 200, response.status
+            for _ in response.response:  # stream it, like a real client would
+                pass
+            response.close()
+    return results
+
+def child_argv(args, n, out):
+    argv = [sys.executable, __file__, '--sizes', str(n), '--save', out,
+            '--tasks', str(args.tasks), '--rounds', str(args.rounds),
+            '--mousemove-hz', str(args.mousemove_hz), '--jobs', str(args.jobs), '--seed', str(args.seed)]
+    for flag in ['compress', 'jsonl', 'no_memory', 'keep']:
+        if getattr(args, flag):
+            argv.append('--' + flag.replace('_', '-'))
+    return argv
+
+def fetch_data_auth():
+    import base64
+    from psiturk.psiturk_config import PsiturkConfig
+    config = PsiturkConfig()
+    config.load_config()
+    user = config.get('Server Parameters', 'login_username')
+    pw = config.get('Server Parameters', 'login_pw')
+    return {'Authorization': 'Basic ' + base64.b64encode(f'{user}:{pw}'.encode()).decode()}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", help="Numbers of participants to try", type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument("--tasks", help="Tasks per participant (the first is practice)", type=int, default=4)
+    parser.add_argument("--rounds", help="Rounds per task", type=int, default=5)
+    parser.add_argument("--mousemove-hz", help="Mouse positions recorded per second while a target is up", type=int, default=30)
+    parser.add_argument("--compress", help="Store datastrings compressed (see datastore.py)", action="store_true")
+    parser.add_argument("--jsonl", help="Have write_data write line-delimited JSON", action="store_true")
+    parser.add_argument("--jobs", help="Processes for process_data", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", help="Don't track peak memory (faster, more accurate timings)", action="store_true")
+    parser.add_argument("--save", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare against results saved with --save")
+    parser.add_argument("--keep", help="Don't delete the temporary directories", action="store_true")
+    args = parser.parse_args()
+
+    project = os.getcwd()
+    all_results = []
+    for n in args.sizes:
+        # psiturk connects to the database when it's imported, so each size gets its own process
+        if len(args.sizes) > 1:
+            import subprocess
+            fd, out = tempfile.mkstemp(suffix='.json')
+            os.close(fd)
+            subprocess.run(child_argv(args, n, out), check=True)
+            with open(out) as f:
+                all_results.extend(json.load(f))
+            os.remove(out)
+            continue
+
+        tmp = tempfile.mkdtemp(prefix='benchmark-')
+        os.environ['DATABASE_URL'] = f'sqlite:///{tmp}/participants.db'
+        sys.path.insert(0, project)  # for custom.py and datastore.py
+        # psiturk reads config.txt from the working directory, so load it before moving
+        importlib.import_module('psiturk.experiment')
+        auth = fetch_data_auth()
+        os.chdir(tmp)
+        try:
+            all_results.extend(run_size(n, args, auth))
+        finally:
+            os.chdir(project)
+            if args.keep:
+                print('Kept', tmp)
+            else:
+                shutil.rmtree(tmp)
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = {(r['stage'], r['participants']): r for r in json.load(f)}
+        print('\nCompared to', args.compare)
+        for r in all_results:
+            print_result(r, before.get((r['stage'], r['participants'])))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(all_results, f, indent=2)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Make sure the participants table is indexed for the lookups we do.
+
+    python bin/db_indexes.py             # create missing indexes on the remote database
+    python bin/db_indexes.py --local     # ... or on the local one
+    python bin/db_indexes.py --benchmark # show query plans and timings before and after
+    python bin/db_indexes.py --benchmark --synthetic 50000  # try it on a fake database
+
+The server also runs ensure_indexes() at startup (see herokuapp.py).
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import time
+from functools import cache
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+# uniqueid is the primary key, so it is always indexed. codeversion is
+# filtered on by /data, /view_data and fetch_data (often together with
+# status), and workerid by fetch_data and psiturk itself.
+INDEXES = {
+    'ix_participants_codeversion_status': ('codeversion', 'status'),
+    'ix_participants_workerid': ('workerid',),
+}
+
+@cache  # an Index attaches itself to the table, so only make each one once
+def index_objects(table):
+    from sqlalchemy import Index
+    return [Index(name, *(table.c[col] for col in cols)) for name, cols in INDEXES.items()]
+
+def missing_indexes(engine, table):
+    """Names of indexes in INDEXES that don't exist yet."""
+    from sqlalchemy import inspect
+    existing = {ix['name'] for ix in inspect(engine).get_indexes(table.name)}
+    return [name for name in INDEXES if name not in existing]
+
+def ensure_indexes(engine=None, verbose=True):
+    """Create any missing indexes. Safe to run repeatedly."""
+    from psiturk.db import init_db
+    from psiturk.models import Participant
+    if engine is None:
+        from psiturk.db import engine
+    init_db()  # the table might not exist yet
+    table = Participant.__table__
+    missing = missing_indexes(engine, table)
+    for ix in index_objects(table):
+        if ix.name in missing:
+            if verbose:
+                print('Creating index', ix.name)
+            ix.create(engine)
+    return missing
+
+def drop_indexes(engine):
+    from psiturk.models import Participant
+    table = Participant.__table__
+    for ix in index_objects(table):
+        if ix.name not in missing_indexes(engine, table):
+            print('Dropping index', ix.name)
+            ix.drop(engine)
+
+# ---------- benchmark ---------- #
+
+def lookups(engine, table):
+    """The queries we care about, with realistic parameters drawn from the table."""
+    from sqlalchemy import text
+    with engine.connect() as conn:
+        row = conn.execute(text(
+            f'SELECT uniqueid, workerid, codeversion FROM {table.name} ORDER BY beginhit DESC LIMIT 1'
+        )).fetchone()
+    if row is None:
+        return []
+    uniqueid, workerid, codeversion = row
+    return [
+        ('uniqueid', f'SELECT status, bonus FROM {table.name} WHERE uniqueid = :x', uniqueid),
+        ('codeversion', f'SELECT uniqueid, status FROM {table.name} WHERE codeversion = :x', codeversion),
+        ('codeversion+status', f'SELECT uniqueid FROM {table.name} WHERE codeversion = :x AND status = 3', codeversion),
+        ('workerid', f'SELECT uniqueid, status FROM {table.name} WHERE workerid = :x', workerid),
+    ]
+
+def query_plan(conn, sql, x):
+    from sqlalchemy import text
+    if conn.dialect.name == 'sqlite':
+        rows = conn.execute(text('EXPLAIN QUERY PLAN ' + sql), {'x': x})
+        return '; '.join(r[-1] for r in rows)
+    else:
+        rows = conn.execute(text('EXPLAIN ' + sql), {'x': x})
+        return '; '.join(str(r[0]).strip() for r in rows)
+
+def time_query(conn, sql, x, repeat):
+    from sqlalchemy import text
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(text(sql), {'x': x}).fetchall()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def report(engine, table, repeat):
+    with engine.connect() as conn:
+        for name, sql, x in lookups(engine, table):
+            ms = 1000 * time_query(conn, sql, x, repeat)
+            print(f'  {name:20} {ms:8.3f} ms   {query_plan(conn, sql, x)}')
+
+def benchmark(engine, repeat=20):
+    from sqlalchemy import func
+    from psiturk.db import db_session, init_db
+    from psiturk.models import Participant
+    init_db()
+    table = Participant.__table__
+    n = db_session.query(func.count(Participant.uniqueid)).scalar()
+    print(f'{engine.dialect.name} database with {n} participants (median of {repeat} runs)')
+    if n == 0:
+        print('Nothing to benchmark. Try --synthetic N')
+        return
+    print('\nBefore')
+    report(engine, table, repeat)
+    if not ensure_indexes(engine):
+        print('(all indexes already existed; use --drop to see the unindexed plans)')
+    print('\nAfter')
+    report(engine, table, repeat)
+
+def make_synthetic(n, versions=20):
+    """Fill the (empty) database with n fake participants spread over several versions."""
+    from datetime import datetime, timedelta
+    from psiturk.db import engine, init_db
+    from psiturk.models import Participant
+    init_db()
+    start = datetime(2020, 1, 1)
+    rows = [{
+        'uniqueid': f'w{i}:a{i}',
+        'assignmentid': f'a{i}',
+        'workerid': f'w{i}',
+        'hitid': 'prolific',
+        'ipaddress': '127.0.0.1',
+        'cond': 0, 'counterbalance': 0,
+        'codeversion': f'v{i % versions}',
+        'beginhit': start + timedelta(minutes=i),
+        'status': random.choice([1, 2, 3, 4, 5, 6]),
+        'mode': 'live',
+        'datastring': '{}',
+    } for i in range(n)]
+    with engine.begin() as conn:
+        conn.execute(Participant.__table__.insert(), rows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--local", help="Use local database", action="store_true")
+    parser.add_argument("--benchmark", help="Show query plans and timings before and after indexing", action="store_true")
+    parser.add_argument("--drop", help="Drop the indexes first (to see the unindexed plans)", action="store_true")
+    parser.add_argument("--synthetic", help="Benchmark a temporary sqlite database with this many fake participants", type=int)
+    parser.add_argument("--repeat", help="Number of times to run each query", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        synthetic_dir = tempfile.mkdtemp(prefix='db_indexes-')
+        os.environ["DATABASE_URL"] = f'sqlite:///{synthetic_dir}/participants.db'
+    elif not args.local:
+        from fetch_data import get_database
+        os.environ["ON_CLOUD"] = "1"
+        os.environ["PORT"] = ""
+        os.environ["DATABASE_URL"] = get_database()
+
+    try:
+        from psiturk.db import engine  # must be imported after setting env params
+        if args.synthetic:
+            make_synthetic(args.synthetic)
+        if args.drop:
+            drop_indexes(engine)
+        if args.benchmark or args.synthetic:
+            benchmark(engine, args.repeat)
+        else:
+            if not ensure_indexes(engine):
+                print('All indexes exist')
+    finally:
+        if args.synthetic:
+            shutil.rmtree(synthetic_dir)
@@ -1,20 +1,28 @@
 import configparser
 import os
 
+# environment variable -> (section, key) in config.txt
+ENV = {
+    'DATABASE_URL': ('Database Parameters', 'database_url'),
+    'PORT': ('Server Parameters', 'port'),
+    # set by Heroku from the dyno size
+    'WEB_CONCURRENCY': ('Server Parameters', 'threads'),
+    'WEB_THREADS': ('Server Parameters', 'worker_threads'),
+    'WORKER_CLASS': ('Server Parameters', 'worker_class'),
+    'DATABASE_MAX_CONNECTIONS': ('Database Parameters', 'max_connections'),
+}
+
 
 def copy_env_to_config():
     c = configparser.ConfigParser()
     c.read('config.txt')
 
     changed = False
-    if 'DATABASE_URL' in os.environ:
-        c['Database Parameters']['database_url'] = os.environ['DATABASE_URL']
-        changed = True
-    if 'PORT' in os.environ:
-        c['Server Parameters']['port'] = os.environ['PORT']
-        changed = True
+    for var, (section, key) in ENV.items():
+        if var in os.environ:
+            c[section][key] = os.environ[var]
+            changed = True
 
     if changed:
         with open('config.txt', 'w') as out:
             c.write(out)
-
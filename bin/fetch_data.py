@@ -1,14 +1,28 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import subprocess
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import hashlib
 import json
 import glob
 import csv
+import inspect
+import multiprocessing
+import pickle
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import cache, partial
+import preprocessing
 from preprocessing import DataProcessor
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datastore  # lives next to custom.py
+
 # set environment parameters so that we use the remote database
 
 def get_database():
@@ -38,56 +52,372 @@ class Anonymizer(object):
 def pick(obj, keys):
     return {k: obj.get(k, None) for k in keys}
 
-def write_csv(file, data, header=True):
+class RowSpool(object):
+    """Collects rows in a temporary file while keeping track of their keys.
+
+    This lets us write a CSV whose header covers every row without holding
+    all the rows in memory. Iterating over the spool reads the rows back.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.keys = {}  # used as an ordered set
+
+    def extend(self, rows):
+        for row in rows:
+            self.keys.update(dict.fromkeys(row))
+            pickle.dump(row, self.file)
+
+    def __iter__(self):
+        self.file.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.file)
+            except EOFError:
+                self.file.seek(0, os.SEEK_END)
+                return
+
+def column_names(data):
     # Preserve order from first dict and add any new keys from subsequent dicts
-    keys = list(data[0].keys())
-    for d in data[1:]:
-        for k in d.keys():
-            if k not in keys:
-                keys.append(k)
+    if isinstance(data, RowSpool):
+        return list(data.keys)
+    keys = {}
+    for d in data:
+        keys.update(dict.fromkeys(d))
+    return list(keys)
 
+def write_csv(file, data, header=True):
     with open(file, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=keys)
+        writer = csv.DictWriter(csvfile, fieldnames=column_names(data))
         if header:
             writer.writeheader()
         for row in data:
             writer.writerow(row)
 
-
-def process_data(version):
+def write_json(file, data):
+    # same output as json.dump(list(data), f), one row at a time
+    with open(file, 'w') as f:
+        f.write('[')
+        for i, row in enumerate(data):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(row))
+        f.write(']')
+
+
+def column_types(data, keys):
+    kinds = {k: set() for k in keys}
+    for d in data:
+        for k in keys:
+            v = d.get(k)
+            if v is not None:
+                kinds[k].add(type(v))
+    types = {}
+    for k, kind in kinds.items():
+        if kind and kind <= {bool}:
+            types[k] = 'bool'
+        elif kind and kind <= {int}:
+            types[k] = 'int'
+        elif kind and kind <= {int, float}:
+            types[k] = 'float'
+        else:
+            types[k] = 'str'
+    return types
+
+def column_values(rows, k, kind):
+    values = [d.get(k) for d in rows]
+    if kind == 'str':
+        values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+    return values
+
+def batches(data, size):
+    batch = []
+    for row in data:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def savez(file, arrays):
+    # what np.savez_compressed does, but without passing the column names as
+    # keyword arguments (a column called "file" would clash with its argument).
+    # arrays is an iterable of (name, array) pairs, written one at a time.
+    import zipfile
+    import numpy as np
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, array in arrays:
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, array, allow_pickle=False)
+
+def write_columnar(file, data, format, batch_size=10000):
+    """Write rows to a typed columnar file (parquet, feather, or npz).
+
+    Like write_csv, rows may have different keys; missing values become nulls
+    (or NaN/'' in npz). Columns that mix types are stored as strings. Returns
+    the name of the file that was written.
+
+    data is read twice (once for the column types, once to write), and parquet
+    and feather are written batch_size rows at a time, so memory doesn't grow
+    with the dataset. npz can't be appended to, so it holds one whole column
+    in memory at a time.
+    """
+    keys = column_names(data)
+    types = column_types(data, keys)
+
+    if format in ('parquet', 'feather'):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            print(f'pyarrow is not installed, writing npz instead of {format}')
+            format = 'npz'
+    file = f'{file}.{format}'
+
+    if format == 'npz':
+        import numpy as np
+        def arrays():
+            for k in keys:
+                values = column_values(data, k, types[k])
+                if types[k] == 'str':
+                    yield k, np.array(['' if v is None else v for v in values], dtype=str)
+                elif None in values:
+                    yield k, np.array([np.nan if v is None else v for v in values], dtype=float)
+                else:
+                    yield k, np.array(values, dtype={'bool': bool, 'int': np.int64, 'float': float}[types[k]])
+        savez(file, arrays())
+        return file
+
+    arrow_types = {'bool': pa.bool_(), 'int': pa.int64(), 'float': pa.float64(), 'str': pa.string()}
+    schema = pa.schema([(k, arrow_types[types[k]]) for k in keys])
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(file, schema)
+    else:
+        # feather v2 is the arrow IPC file format
+        compression = 'lz4' if pa.Codec.is_available('lz4') else None
+        writer = pa.ipc.new_file(file, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+    with writer:
+        for rows in batches(data, batch_size):
+            writer.write_table(pa.table(
+                [pa.array(column_values(rows, k, types[k]), type=schema.field(k).type) for k in keys],
+                schema=schema))
+    return file
+
+
+class Profiler(object):
+    """Wall time and memory of each stage, for --profile.
+
+    Stages that run once per participant are also timed per participant, so
+    that the report can point out the slow ones. Does nothing unless enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_parser = None
+        self.cprofile = None
+        self.cprofile_calls = 0
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.peak = defaultdict(float)
+        self.items = defaultdict(dict)  # stage -> {participant: seconds}
+
+    def enable(self, cprofile_parser=None):
+        self.enabled = True
+        tracemalloc.start()
+        if cprofile_parser:
+            import cProfile
+            self.cprofile_parser = cprofile_parser
+            self.cprofile = cProfile.Profile()
+
+    @contextmanager
+    def stage(self, name, item=None):
+        if not self.enabled:
+            yield
+            return
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+        self.peak[name] = max(self.peak[name], (tracemalloc.get_traced_memory()[1] - base) / 1e6)
+        if item is not None:
+            self.items[name][item] = self.items[name].get(item, 0) + seconds
+
+    @contextmanager
+    def parser(self, method, item):
+        with self.stage(f'parser: {method}', item):
+            if method == self.cprofile_parser:
+                self.cprofile_calls += 1
+                self.cprofile.enable()
+            try:
+                yield
+            finally:
+                if method == self.cprofile_parser:
+                    self.cprofile.disable()
+
+    def report(self, cprofile_file=None, outliers=3):
+        if not self.enabled:
+            return
+        print(f"\n{'stage':32} {'calls':>6} {'total s':>9} {'mean ms':>9} {'peak MB':>8}")
+        for name in self.seconds:
+            print(f"{name:32} {self.calls[name]:>6} {self.seconds[name]:9.3f} "
+                  f"{1000 * self.seconds[name] / self.calls[name]:9.2f} {self.peak[name]:8.1f}")
+            times = self.items.get(name)
+            if times and len(times) > 1:
+                median = sorted(times.values())[len(times) // 2]
+                slowest = sorted(times, key=times.get, reverse=True)[:outliers]
+                print(' ' * 4 + 'slowest: ' + ', '.join(
+                    f'{item} {1000 * times[item]:.1f}ms ({times[item] / median:.0f}x median)' if median else
+                    f'{item} {1000 * times[item]:.1f}ms' for item in slowest))
+        if self.cprofile is not None and not self.cprofile_calls:
+            print(f'\nThe {self.cprofile_parser} parser never ran, so there is no cProfile output (did you pass --process?)')
+        elif self.cprofile is not None:
+            import pstats
+            os.makedirs(os.path.dirname(cprofile_file), exist_ok=True)
+            self.cprofile.dump_stats(cprofile_file)
+            print(f'\ncProfile of {self.cprofile_parser} (saved to {cprofile_file}):')
+            pstats.Stats(self.cprofile).sort_stats('cumulative').print_stats(20)
+
+PROFILE = Profiler()
+
+
+def parse_methods():
+    return [m for m in dir(DataProcessor) if hasattr(getattr(DataProcessor, m), '_parser')]
+
+@cache
+def parser_versions():
+    # A parser's cached rows are valid as long as its own source and the rest
+    # of preprocessing.py (helpers, find_events, ...) are unchanged.
+    parsers = {m: inspect.getsource(inspect.unwrap(getattr(DataProcessor, m))) for m in parse_methods()}
+    shared = inspect.getsource(preprocessing)
+    for source in parsers.values():
+        shared = shared.replace(source, '')
+    return {m: hashlib.md5((shared + source).encode()).hexdigest() for m, source in parsers.items()}
+
+def file_hash(file):
+    h = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_and_parse(json_file, methods):
+    if not PROFILE.enabled:
+        processor = DataProcessor.load(json_file, stream=True)
+        return processor.parse(methods)
+
+    # when profiling, load everything up front and run one parser at a time
+    # so that each stage gets its own timing
+    wid = os.path.splitext(os.path.basename(json_file))[0]
+    with PROFILE.stage('load events (json decode)', wid):
+        processor = DataProcessor.load(json_file)
+    with PROFILE.stage('find_events index', wid):
+        processor._index
+    results = {}
+    for method in methods:
+        with PROFILE.parser(method, wid):
+            results.update(processor.parse([method]))
+    return results
+
+def parse_file(json_file, cache_dir=None):
+    methods = parse_methods()
+    if cache_dir is None:
+        return load_and_parse(json_file, methods)
+
+    # only rerun the parsers whose code or input changed since the last run
+    cache_file = os.path.join(cache_dir, os.path.basename(json_file) + '.pkl')
+    entry = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            entry = pickle.load(f)
+    digest = file_hash(json_file)
+    if entry.get('file') != digest:
+        entry = {'file': digest, 'parsers': {}}
+
+    versions = parser_versions()
+    cached = entry['parsers']
+    stale = [m for m in methods if m not in cached or cached[m][0] != versions[m]]
+    if stale:
+        for method, rows in load_and_parse(json_file, stale).items():
+            cached[method] = (versions[method], rows)
+        entry['parsers'] = {m: cached[m] for m in methods}
+        with open(cache_file, 'wb') as f:
+            pickle.dump(entry, f)
+    return {m: cached[m][1] for m in methods}
+
+def process_data(version, jobs=1, format='csv', use_cache=True):
     input_dir = f"data/raw/{version}/events"
     output_dir = f"data/processed/{version}"
     os.makedirs(output_dir, exist_ok=True)
+    cache_dir = f"{output_dir}/.cache" if use_cache else None
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
     assert os.path.exists(input_dir), f"Input directory {input_dir} does not exist"
 
     # Find all parse methods
-    parse_methods = [m for m in dir(DataProcessor) if hasattr(getattr(DataProcessor, m), '_parser'  )]    
-    results = {m: [] for m in parse_methods}
-
-    # Process each JSON file
-    for json_file in glob.glob(f"{input_dir}/*.json"):
-        print(json_file)
-        processor = DataProcessor.load(json_file)
-        
-        for method in parse_methods:
-            results[method].extend(getattr(processor, method)())
+    methods = parse_methods()
+    # rows are spooled to disk as they come in; only one participant is in memory at a time
+    results = {m: RowSpool() for m in methods}
+
+    # Process each JSON file. With multiple jobs, files are parsed in parallel
+    # but results still come back in file order, so the output is the same.
+    json_files = sorted(glob.glob(f"{input_dir}/*.json") + glob.glob(f"{input_dir}/*.jsonl"))
+    if jobs > 1 and PROFILE.enabled:
+        print('Profiling runs in a single process; ignoring --jobs')
+        jobs = 1
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        if pool is not None:
+            parsed = pool.imap(partial(parse_file, cache_dir=cache_dir), json_files, chunksize=4)
+        else:
+            parsed = (parse_file(json_file, cache_dir) for json_file in json_files)
+
+        for json_file, result in zip(json_files, parsed):
+            print(json_file)
+            with PROFILE.stage('collect rows'):
+                for method in methods:
+                    results[method].extend(result[method])
+    finally:
+        # by now every result is in (or a parser raised), so don't leave workers behind
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     # Save results
     for method, data in results.items():
-        kind = getattr(processor, method)._parser
-        if kind == 'csv':
-            output_name = method + '.csv'
-            write_csv(f"{output_dir}/{output_name}", data)
-            print(f"Wrote {output_dir}/{output_name}")
-        elif kind == 'json':
-            output_name = method + '.json'
-            with open(f"{output_dir}/{output_name}", 'w') as f:
-                json.dump(data, f)
-            print(f"Wrote {output_dir}/{output_name}")
+        kind = getattr(DataProcessor, method)._parser
+        with PROFILE.stage(f'write output: {method}'):
+            if kind == 'csv' and format != 'csv':
+                output_file = write_columnar(f"{output_dir}/{method}", data, format)
+                print(f"Wrote {output_file}")
+            elif kind == 'csv':
+                output_name = method + '.csv'
+                write_csv(f"{output_dir}/{output_name}", data)
+                print(f"Wrote {output_dir}/{output_name}")
+            elif kind == 'json':
+                output_name = method + '.json'
+                write_json(f"{output_dir}/{output_name}", data)
+                print(f"Wrote {output_dir}/{output_name}")
+
+
+def participant_meta(datastring, wid):
+    metakeys = ['condition', 'counterbalance', 'assignmentId', 'hitId', 'useragent', 'mode', 'status']
+    meta = pick(datastring, metakeys)
+    meta['wid'] = wid
+    for k, v in datastring['questiondata'].items():
+        if k.lower() == 'params':
+            for k1, v1 in v.items():
+                if k1 == 'graphRenderOptions':
+                    continue
+                meta[k1] = v1
 
+        else:
+            meta[k] = v
+    return meta
 
 
-def write_data(version, mode):
+def write_data(version, mode, incremental=False, jsonl=False):
     anonymize = Anonymizer(enabled = mode == 'live')
 
     if mode != 'local':
@@ -98,57 +428,124 @@ def write_data(version, mode):
         # what should go here??
 
     from psiturk.models import Participant  # must be imported after setting env params
-    ps = Participant.query.filter(Participant.codeversion == version).all()
+    from psiturk.db import db_session, engine
+    from sqlalchemy import func, inspect
+    import deltas
+
+    # First get a cheap summary of each participant (without the datastring).
+    # A participant only needs to be re-downloaded if their status, the
+    # length of their datastring or their last saved delta changed since the
+    # last fetch.
+    with PROFILE.stage('db: summary query'):
+        rows = (
+            Participant.query
+            .filter(Participant.codeversion == version)
+            .with_entities(Participant.uniqueid, Participant.workerid, Participant.status,
+                           func.length(Participant.datastring), Participant.bonus)
+            .all()
+        )
+
+        # saves since the last fold (see deltas.py); older databases won't have the table
+        has_deltas = deltas.Delta.__tablename__ in inspect(engine).get_table_names()
+        last_seq = dict(
+            db_session.query(deltas.Delta.uniqueid, func.max(deltas.Delta.seq))
+            .group_by(deltas.Delta.uniqueid)
+        ) if has_deltas else {}
 
     if mode == 'live':
-        ps = [p for p in ps
-            if 'debug' not in p.uniqueid
-            and not p.workerid.startswith('601055')  # the "preview" participant
+        rows = [r for r in rows
+            if 'debug' not in r.uniqueid
+            and not r.workerid.startswith('601055')  # the "preview" participant
         ]
     # Note: we don't filter by completion status.
 
-    metakeys = ['condition', 'counterbalance', 'assignmentId', 'hitId', 'useragent', 'mode', 'status']
-    participants = []
+    # manifest.json records what we have already written for each participant
+    manifest_file = f'data/raw/{version}/manifest.json'
+    manifest = {}
+    if incremental and os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            previous = json.load(f)
+        if previous['mode'] == mode:  # otherwise the wids are different
+            manifest = previous['participants']
+
+    watermarks = {uniqueid: [status, length, last_seq.get(uniqueid)] for uniqueid, workerid, status, length, _ in rows}
+    stale = [uid for uid, mark in watermarks.items()
+             if uid not in manifest or manifest[uid]['watermark'] != mark]
+    if incremental:
+        print(f'{len(stale)} of {len(rows)} participants changed since the last fetch')
 
     os.makedirs(f'data/raw/{version}/events/', exist_ok=True)
+    for i in range(0, len(stale), 100):
+        with PROFILE.stage('db: fetch datastrings'):
+            chunk = (
+                Participant.query
+                .filter(Participant.uniqueid.in_(stale[i:i+100]))
+                .with_entities(Participant.uniqueid, Participant.workerid, Participant.datastring)
+                .all()
+            )
+            pending = deltas.load(stale[i:i+100]) if has_deltas else {}
+        for uniqueid, workerid, datastring in chunk:
+            entry = {'watermark': watermarks[uniqueid], 'workerid': workerid, 'meta': None}
+            manifest[uniqueid] = entry
+            if datastring is None and uniqueid not in pending:
+                continue
+            with PROFILE.stage('anonymize'):
+                wid = anonymize(workerid)
+            with PROFILE.stage('json decode', wid):
+                try:
+                    datastring = json.loads(datastore.decode(datastring)) if datastring is not None else {}
+                    deltas.assemble(datastring, pending.get(uniqueid, []))
+                except ValueError as e:
+                    print(f'WARNING: skipping {uniqueid}, whose data could not be read ({e})')
+                    continue
+            entry['meta'] = participant_meta(datastring, wid)
+
+            events_file = f'data/raw/{version}/events/{wid}.json'
+            with PROFILE.stage('write events', wid):
+                if jsonl:
+                    # one event per line, so it can be written and read back one event at a time
+                    with open(events_file + 'l', 'w') as f:
+                        for d in datastring['data']:
+                            f.write(json.dumps(d['trialdata']) + '\n')
+                else:
+                    trialdata = [d['trialdata'] for d in datastring['data']]
+                    with open(events_file, 'w') as f:
+                        json.dump(trialdata, f)
+
+            # don't leave a stale copy in the other format
+            stale_file = events_file if jsonl else events_file + 'l'
+            if os.path.isfile(stale_file):
+                os.remove(stale_file)
+
+    # the summary files are rebuilt from the manifest, covering everyone
+    participants = []
     bonus = {}
-    for p in ps:
-        if p.datastring is None:
+    for uniqueid, workerid, status, length, running_bonus in rows:
+        meta = manifest[uniqueid]['meta']
+        if meta is None:
             continue
-        datastring = json.loads(p.datastring)
-
-        wid = anonymize(p.workerid)
-
-        meta = pick(datastring, metakeys)
-        meta['wid'] = wid
-        for k, v in datastring['questiondata'].items():
-            if k.lower() == 'params':
-                for k1, v1 in v.items():
-                    if k1 == 'graphRenderOptions':
-                        continue
-                    meta[k1] = v1
-
-            else:
-                meta[k] = v
+        anonymize(workerid)
         participants.append(meta)
         if 'bonus' in meta:
-            bonus[p.workerid] = meta['bonus']
+            bonus[workerid] = meta['bonus']
+        elif running_bonus:
+            # computed by the server as data came in (see update_aggregates in custom.py)
+            bonus[workerid] = running_bonus
 
-        trialdata = [d['trialdata'] for d in datastring['data']]
+    with PROFILE.stage('write summary files'):
+        write_csv(f'data/raw/{version}/participants.csv', participants)
 
-        with open(f'data/raw/{version}/events/{wid}.json', 'w') as f:
-            json.dump(trialdata, f)
+        with open(f'data/raw/{version}/identifiers.json', 'w') as f:
+            json.dump(anonymize.mapping, f)
 
-    write_csv(f'data/raw/{version}/participants.csv', participants)
+        with open(f'data/raw/{version}/bonus.json', 'w') as f:
+            json.dump(bonus, f)
 
-    with open(f'data/raw/{version}/identifiers.json', 'w') as f:
-        json.dump(anonymize.mapping, f)
+        with open(f'bonus.json', 'w') as f:
+            json.dump(bonus, f)
 
-    with open(f'data/raw/{version}/bonus.json', 'w') as f:
-        json.dump(bonus, f)
-
-    with open(f'bonus.json', 'w') as f:
-        json.dump(bonus, f)
+        with open(manifest_file, 'w') as f:
+            json.dump({'mode': mode, 'participants': {r.uniqueid: manifest[r.uniqueid] for r in rows}}, f)
 
     print(len(participants), 'participants')
     print(f'data/raw/{version}/participants.csv')
@@ -166,6 +563,14 @@ if __name__ == "__main__":
     parser.add_argument("--local", help="Use local database (implies --debug)", action="store_true")
     parser.add_argument("--nofetch", help="Skip fetching data", action="store_true")
     parser.add_argument("--process", help="Process the data", action="store_true")
+    parser.add_argument("--jsonl", help="Write events as line-delimited JSON (easier to stream)", action="store_true")
+    parser.add_argument("--format", help="Output format for csv parsers (parquet and feather require pyarrow)",
+                        choices=['csv', 'parquet', 'feather', 'npz'], default='csv')
+    parser.add_argument("--no-cache", help="Reprocess every participant, ignoring cached results", action="store_true")
+    parser.add_argument("--jobs", help="Number of processes to use for processing", type=int, default=1)
+    parser.add_argument("--incremental", help="Only download participants that changed since the last fetch", action="store_true")
+    parser.add_argument("--profile", help="Report the time and memory of each stage, and the slowest participants (implies --no-cache)", action="store_true")
+    parser.add_argument("--cprofile", help="Like --profile, but also run cProfile on this parser (e.g. trials)", metavar="PARSER")
 
     args = parser.parse_args()
     mode = 'local' if args.local else 'debug' if args.debug else 'live'
@@ -178,7 +583,15 @@ if __name__ == "__main__":
         version = c["Task Parameters"]["experiment_code_version"]
         print("Using current version: ", version)
 
+    if args.profile or args.cprofile:
+        if args.cprofile and args.cprofile not in parse_methods():
+            parser.error(f'--cprofile must be one of: {", ".join(parse_methods())}')
+        PROFILE.enable(args.cprofile)
+        # cached participants skip loading and parsing, which is what we want to see
+        args.no_cache = True
+
     if not args.nofetch:
-        write_data(version, mode)
+        write_data(version, mode, args.incremental, args.jsonl)
     if args.process:
-        process_data(version)
+        process_data(version, args.jobs, args.format, not args.no_cache)
+    PROFILE.report(cprofile_file=f'data/processed/{version}/{args.cprofile}.prof')
@@ -4,14 +4,125 @@ env_to_config.copy_env_to_config()
 
 # Now the code
 
-import configparser
-import psiturk.experiment_server as exp
+import os
+import hashlib
+import multiprocessing
+from gunicorn.app.base import BaseApplication
+from psiturk.psiturk_config import PsiturkConfig
+import db_indexes
 
-config = configparser.ConfigParser()
-config.read('config.txt')
+config = PsiturkConfig()
+config.load_config()
 sp = config['Server Parameters']
 
-host = 'http://localhost' if sp['host'] == '0.0.0.0' else sp['host']
-print(f'Server listening on {host}:{sp["port"]}')
+LOGLEVELS = ["debug", "info", "warning", "error", "critical"]
 
-exp.launch()
+
+class ExperimentServer(BaseApplication):
+    """Like psiturk's server, but with a choice of worker class.
+
+    psiturk always uses gevent workers, which only help if the database
+    driver cooperates with gevent. psycopg2 doesn't (without psycogreen), so
+    while one participant's save is waiting on Postgres, every other request
+    to that worker waits too. With worker_class = gthread, each worker runs
+    worker_threads real threads instead.
+    """
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for k, v in self.options.items():
+            self.cfg.set(k, v)
+
+    def load(self):
+        from psiturk.experiment import app
+        return app
+
+
+def server_options():
+    # psiturk calls the number of worker processes "threads"
+    workers = sp['threads']
+    workers = multiprocessing.cpu_count() * 2 + 1 if workers == 'auto' else int(workers)
+    if workers > 1 and config.getboolean('Server Parameters', 'do_scheduler'):
+        raise Exception(f'Scheduler is not thread-safe, but {workers} gunicorn workers requested! Refusing to start!')
+
+    worker_class = sp.get('worker_class', 'gevent')
+    options = {
+        'bind': f"{sp['host']}:{sp['port']}",
+        'workers': workers,
+        'worker_class': worker_class,
+        'threads': config.getint('Server Parameters', 'worker_threads', fallback=1) if worker_class == 'gthread' else 1,
+        'loglevel': LOGLEVELS[config.getint('Server Parameters', 'loglevel')],
+        'accesslog': sp['accesslog'],
+        'errorlog': sp['logfile'],
+        'timeout': sp['server_timeout'],
+        'limit_request_line': 0,
+        # same name as psiturk's server, so `psiturk server off` etc still find it
+        'proc_name': 'psiturk_experiment_server_' + hashlib.sha1(os.getcwd().encode()).hexdigest()[:12],
+        'post_fork': post_fork,
+    }
+    if sp.get('certfile') and sp.get('keyfile'):
+        options.update(certfile=sp['certfile'], keyfile=sp['keyfile'])
+    return options
+
+
+def configure_database(options):
+    """Replace psiturk's engine with one whose pool fits the server.
+
+    The database allows max_connections in total, which are split between
+    the worker processes. Each worker never needs more connections than it
+    handles requests at once (a gthread worker has `threads` of them).
+    """
+    import psiturk.db
+    from sqlalchemy import create_engine
+    url = psiturk.db.engine.url
+    if url.get_backend_name() == 'sqlite':
+        return  # no pool to size (and fine for testing, but don't use it with many participants)
+
+    max_connections = config.getint('Database Parameters', 'max_connections', fallback=20)
+    per_worker = max(1, max_connections // options['workers'])
+    if options['worker_class'] != 'gevent':
+        per_worker = min(per_worker, options['threads'])
+    engine = create_engine(
+        url, pool_size=per_worker, max_overflow=0, pool_timeout=int(options['timeout']), pool_recycle=3600,
+        pool_pre_ping=config.getboolean('Database Parameters', 'pool_pre_ping', fallback=True),
+    )
+    psiturk.db.engine.dispose()
+    psiturk.db.engine = engine
+    psiturk.db.db_session.configure(bind=engine)
+    print(f'Database pool: {per_worker} connections per worker ({options["workers"]} workers)')
+
+
+def post_fork(server, worker):
+    if server.cfg.worker_class_str != 'gevent':
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        if config.get('Database Parameters', 'database_url').startswith('postgres'):
+            server.log.warning('gevent workers block on every Postgres query without psycogreen; '
+                               'pip install psycogreen or set worker_class = gthread')
+
+
+if __name__ == "__main__":
+    options = server_options()
+    configure_database(options)
+
+    host = 'http://localhost' if sp['host'] == '0.0.0.0' else sp['host']
+    print(f'Server listening on {host}:{sp["port"]}')
+    print(f'{options["workers"]} {options["worker_class"]} workers' +
+          (f' with {options["threads"]} threads each' if options['worker_class'] == 'gthread' else ''))
+
+    try:
+        db_indexes.ensure_indexes()
+    except Exception as e:
+        # not worth refusing to start over
+        print('Could not create database indexes:', e)
+
+    # connections made so far belong to this process; the workers open their own
+    import psiturk.db
+    psiturk.db.engine.dispose()
+
+    ExperimentServer(options).run()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Simulate a crowd of participants hitting the experiment server at once.
+
+    python bin/loadtest.py --launch                    # start a local server on a throwaway SQLite db
+    python bin/loadtest.py --launch --threads 4        # try a different number of server workers
+    python bin/loadtest.py --launch --worker-class gevent
+    python bin/loadtest.py --launch --database-url postgresql://localhost/loadtest
+    python bin/loadtest.py --url http://localhost:22363   # use a server you started yourself
+
+Each simulated participant goes through the same requests as the real
+experiment: consent, /exp, loading their data, /inexp, a series of saves to
+/sync_delta with more and more data, /complete_exp and /compute_bonus.
+Participants arrive at random over --ramp seconds. For every route we report
+latency percentiles, the error rate, and the time the server spent in the
+database (from the Server-Timing header added in custom.py, which needs
+server_timing = true in config.txt; --launch sets it for you).
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import env_to_config
+from benchmark import synthetic_events
+
+
+class Recorder(object):
+    """Collects latency, status and DB time for each route."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.db_time = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def __call__(self, route, response=None, elapsed=None, error=None):
+        with self.lock:
+            if error is not None or response.status_code >= 400:
+                self.errors[route] += 1
+            if response is not None:
+                self.latency[route].append(elapsed)
+                match = re.search(r'db;dur=([\d.]+)', response.headers.get('Server-Timing', ''))
+                if match:
+                    self.db_time[route].append(float(match.group(1)) / 1000)
+
+    def report(self, wall_time):
+        def pct(xs, p):
+            return 1000 * xs[min(int(p / 100 * len(xs)), len(xs) - 1)] if xs else float('nan')
+        print(f"\n{'route':20} {'n':>6} {'errors':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'db p50':>8} {'db p95':>8}  (ms)")
+        total = 0
+        for route in sorted(set(self.latency) | set(self.errors)):
+            latency = sorted(self.latency[route])
+            db = sorted(self.db_time[route])
+            n = max(len(latency), self.errors[route])
+            total += n
+            print(f"{route:20} {n:>6} {self.errors[route] / n:>7.1%} {pct(latency, 50):8.1f} {pct(latency, 95):8.1f} "
+                  f"{pct(latency, 99):8.1f} {pct(db, 50):8.1f} {pct(db, 95):8.1f}")
+        print(f'\n{total} requests in {wall_time:.1f}s ({total / wall_time:.1f} per second)')
+
+
+def participant(i, args, record):
+    """Go through the experiment as participant i."""
+    rng = random.Random(args.seed + i)
+    time.sleep(rng.uniform(0, args.ramp))
+
+    session = requests.Session()
+    workerid, assignmentid = f'loadtest{args.run}x{i}', f'a{args.run}x{i}'
+    ids = {'hitId': 'prolific', 'assignmentId': assignmentid, 'workerId': workerid, 'mode': 'live'}
+    uid = f'{workerid}:{assignmentid}'
+
+    def request(route, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, args.url + path, timeout=args.timeout, **kwargs)
+        except requests.RequestException as e:
+            record(route, error=e)
+            return None
+        record(route, response, time.perf_counter() - start)
+        return response
+
+    if request('GET /consent', 'GET', '/consent', params=ids) is None:
+        return
+    response = request('GET /exp', 'GET', '/exp', params=ids)
+    if response is None or response.status_code != 200:
+        return
+    request('GET /sync_delta', 'GET', f'/sync_delta/{uid}')
+    request('POST /inexp', 'POST', '/inexp', data={'uniqueId': uid})
+
+    # the event log is sent in --saves pieces, like DATA.save() after each block
+    events = synthetic_events(rng, n_tasks=args.tasks, mousemove_hz=args.mousemove_hz)
+    trials = [{'uniqueid': uid, 'current_trial': j, 'dateTime': e['timestamp'], 'trialdata': e}
+              for j, e in enumerate(events)]
+    step = -(-len(trials) // args.saves)
+    for start in range(0, len(trials), step):
+        time.sleep(rng.uniform(0, 2 * args.think))
+        payload = {
+            'condition': 0, 'counterbalance': 0, 'assignmentId': assignmentid, 'workerId': workerid,
+            'hitId': 'prolific', 'currenttrial': start + step, 'useragent': 'loadtest',
+            'mode': 'live', 'status': 2, 'questiondata': {'params': {'foo': 'bar'}},
+            'data': trials[start:start + step], 'dataStart': start,
+            'eventdata': [], 'eventdataStart': 0,
+        }
+        body = json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json'}
+        if args.gzip and len(body) >= 1024:  # same rule as psiturk.js
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        request('PUT /sync_delta', 'PUT', f'/sync_delta/{uid}', data=body, headers=headers)
+
+    request('POST /complete_exp', 'POST', '/complete_exp', data={'uniqueId': uid})
+    request('GET /compute_bonus', 'GET', '/compute_bonus', params={'uniqueId': uid})
+
+
+def launch_server(args, tmp):
+    """Start bin/herokuapp.py in the background, returning the process."""
+    env = dict(os.environ)
+    for var in env_to_config.ENV:  # env_to_config would copy these into config.txt
+        env.pop(var, None)
+    # PSITURK_ variables override config.txt without herokuapp.py writing them into it
+    env['PSITURK_DATABASE_URL'] = args.database_url or f'sqlite:///{tmp}/participants.db'
+    env['PSITURK_PORT'] = str(args.port)
+    env['PSITURK_HOST'] = '127.0.0.1'
+    env['PSITURK_SERVER_TIMING'] = 'true'
+    if args.threads:
+        env['PSITURK_THREADS'] = str(args.threads)
+    if args.worker_class:
+        env['PSITURK_WORKER_CLASS'] = args.worker_class
+    if args.worker_threads:
+        env['PSITURK_WORKER_THREADS'] = str(args.worker_threads)
+    log = open(os.path.join(tmp, 'server.out'), 'w')
+    server = subprocess.Popen([sys.executable, 'bin/herokuapp.py'], env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'The server exited early; see {log.name}')
+        try:
+            requests.get(args.url + '/', timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.5)
+    server.terminate()
+    sys.exit(f'The server did not start within a minute; see {log.name}')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--participants", help="Number of simulated participants", type=int, default=100)
+    parser.add_argument("--ramp", help="Participants arrive at random over this many seconds", type=float, default=30)
+    parser.add_argument("--saves", help="Number of /sync_delta saves per participant", type=int, default=5)
+    parser.add_argument("--think", help="Mean seconds between saves", type=float, default=2)
+    parser.add_argument("--tasks", help="Tasks per participant (controls how much data they send)", type=int, default=4)
+    parser.add_argument("--mousemove-hz", help="Mouse positions recorded per second while a target is up", type=int, default=30)
+    parser.add_argument("--no-gzip", help="Send saves uncompressed (like older browsers)", dest='gzip', action="store_false")
+    parser.add_argument("--timeout", help="Seconds before a request counts as failed", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="Server to test (ignored with --launch)", default='http://127.0.0.1:22363')
+    parser.add_argument("--launch", help="Start a local server with bin/herokuapp.py for the test", action="store_true")
+    parser.add_argument("--port", help="Port for the launched server", type=int, default=22399)
+    parser.add_argument("--threads", help="Server worker count for the launched server (the threads setting in config.txt)", type=int)
+    parser.add_argument("--worker-class", help="Worker class for the launched server", choices=['gthread', 'gevent', 'sync'])
+    parser.add_argument("--worker-threads", help="Threads per worker for the launched server (with gthread)", type=int)
+    parser.add_argument("--database-url", help="Database for the launched server (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    args.run = int(time.time())  # keeps workerids unique across runs against the same database
+
+    server = tmp = None
+    if args.launch:
+        args.url = f'http://127.0.0.1:{args.port}'
+        tmp = tempfile.mkdtemp(prefix='loadtest-')
+        server = launch_server(args, tmp)
+        print('Launched server at', args.url)
+    args.url = args.url.rstrip('/')
+
+    record = Recorder()
+    print(f'Simulating {args.participants} participants arriving over {args.ramp:.0f}s...')
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(args.participants) as pool:
+            for future in [pool.submit(participant, i, args, record) for i in range(args.participants)]:
+                future.result()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(tmp)
+    record.report(time.perf_counter() - start)
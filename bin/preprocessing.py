@@ -1,4 +1,8 @@
 import json
+import os
+import heapq
+from collections import defaultdict
+from functools import cached_property, lru_cache, wraps
 
 def groupby(objlist, key):
     result = {}
@@ -9,17 +13,121 @@ def groupby(objlist, key):
         result[k].append(obj)
     return result
 
-def csv_parser(f):
-    def wrapper(self, *args, **kwargs):
-        return f(self, *args, **kwargs)
-    wrapper._parser = 'csv'
-    return wrapper
+@lru_cache(maxsize=None)
+def compile_query(query):
+    # one entry per dotted part: None for *, a set of options for (a|b), otherwise the string
+    pattern = []
+    for part in query.split('.'):
+        if part == '*':
+            pattern.append(None)
+        elif '(' in part:
+            pattern.append(frozenset(part.strip('()').split('|')))
+        else:
+            pattern.append(part)
+    return tuple(pattern)
 
-def json_parser(f):
-    def wrapper(self, *args, **kwargs):
-        return f(self, *args, **kwargs)
-    wrapper._parser = 'json'
-    return wrapper
+def match_query(pattern, event_parts):
+    # Allow partial matches - query parts must match start of event parts
+    if len(event_parts) < len(pattern):
+        return False
+    for p, part in zip(pattern, event_parts):
+        if p is None:
+            continue
+        if isinstance(p, frozenset):
+            if part not in p:
+                return False
+        elif p != part:
+            return False
+    return True
+
+def covers(pattern, query_pattern):
+    # whether every event matching query_pattern (with no (a|b) parts) also matches pattern
+    if len(pattern) > len(query_pattern):
+        return False
+    for p, q in zip(pattern, query_pattern):
+        if p is None:
+            continue
+        if q is None:
+            return False
+        if isinstance(p, frozenset):
+            if q not in p:
+                return False
+        elif q != p:
+            return False
+    return True
+
+def iter_json_array(file, chunk_size=1 << 20):
+    # Like json.load for a top-level array, but yields one element at a time
+    # so that only a chunk of the file is ever in memory.
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('expected a JSON array')
+    pos = 1
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+            # make sure the value wasn't cut off by the end of the chunk (e.g. 1.5|e10)
+            complete = eof or (end < len(buffer) and buffer[end] in ' \t\r\n,]')
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if complete:
+            yield value
+            pos = end
+        else:
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+
+def iter_events(path):
+    # events are stored either as one JSON array or as one JSON object per line (.jsonl)
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f)
+
+def make_parser(kind):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if hasattr(f, '_query') and not args and not kwargs:
+                # called like a normal parser: visit every matching event
+                return [row for event in self.find_events(f._query) for row in f(self, event)]
+            return f(self, *args, **kwargs)
+        wrapper._parser = kind
+        return wrapper
+    return decorator
+
+csv_parser = make_parser('csv')
+json_parser = make_parser('json')
+
+def reads(*queries):
+    # Declares which events a (non-visitor) parser looks at. When events are
+    # streamed from disk, only events matching some parser's queries are kept
+    # in memory; parsers without this decorator get every event.
+    def decorator(f):
+        f._reads = queries
+        return f
+    return decorator
+
+def on_event(query):
+    # Turns a parser into a visitor: rather than searching self.events itself, it
+    # is called with each event matching query and yields the rows for that event.
+    # DataProcessor.parse runs all visitors in a single pass over the events.
+    def decorator(f):
+        f._query = query
+        return f
+    return decorator
 
 # NOTE: you'll need to edit this based on your own experiment.
 
@@ -27,50 +135,110 @@ class DataProcessor:
     def __init__(self, wid, events):
         self.wid = wid
         self.events = events
+        self._kept = None  # patterns of the events kept by parse() when streaming (None: all of them)
 
     @classmethod
-    def load(cls, json_file):
-        with open(json_file) as f:
-            events = json.load(f)
-            wid = json_file.split('/')[-1].replace('.json', '')
-            return cls(wid, events)
+    def load(cls, json_file, stream=False):
+        wid = os.path.splitext(os.path.basename(json_file))[0]
+        if stream:
+            # events are read lazily (and only once) by parse()
+            return cls(wid, iter_events(json_file))
+        return cls(wid, list(iter_events(json_file)))
+
+    @cached_property
+    def _index(self):
+        # maps each dotted prefix of an event name, e.g. ('task', 'hit'), to the
+        # positions of the events starting with it, and to the parts that can follow it
+        positions = defaultdict(list)
+        children = defaultdict(dict)
+        for i, event in enumerate(self.events):
+            prefix = ()
+            for part in event['event'].split('.'):
+                children[prefix][part] = None
+                prefix += (part,)
+                positions[prefix].append(i)
+        return positions, children
+
+    def parse(self, methods):
+        """Run the given parser methods, returning a dict from method name to rows."""
+        results = {m: [] for m in methods}
+        visitors = {m: getattr(self, m) for m in methods if hasattr(getattr(self, m), '_query')}
+        patterns = {m: compile_query(visit._query) for m, visit in visitors.items()}
+        others = [m for m in methods if m not in visitors]
+
+        # if the events are being streamed, hold on to the ones the other parsers need
+        streaming = not isinstance(self.events, list)
+        if streaming:
+            needed = [getattr(getattr(self, m), '_reads', None) for m in others]
+            keep_all = None in needed
+            keep_patterns = {compile_query(q) for queries in needed if queries for q in queries}
+            kept = []
+
+        # event names repeat a lot, so only match each distinct name once
+        routes = {}
+        keep = {}
+        for event in self.events:
+            name = event['event']
+            if name not in routes:
+                parts = name.split('.')
+                routes[name] = [m for m, pattern in patterns.items() if match_query(pattern, parts)]
+                keep[name] = streaming and (keep_all or any(match_query(p, parts) for p in keep_patterns))
+            for m in routes[name]:
+                results[m].extend(visitors[m](event))
+            if keep[name]:
+                kept.append(event)
+
+        if streaming:
+            self.events = kept
+            self._kept = None if keep_all else keep_patterns
+        for m in others:
+            results[m].extend(getattr(self, m)())
+        return results
+
+    def _covered(self, pattern):
+        # expand (a|b) so that e.g. @reads("task.a", "task.b") covers "task.(a|b)"
+        alternatives = [()]
+        for p in pattern:
+            options = sorted(p) if isinstance(p, frozenset) else [p]
+            alternatives = [alt + (o,) for alt in alternatives for o in options]
+        return all(any(covers(kept, alt) for kept in self._kept) for alt in alternatives)
 
     def find_events(self, query, events=None):
-        if events is None:
-            events = self.events
-
-        parts = query.split('.')
-        result = []
-        for event in events:
-            event_parts = event['event'].split('.')
-
-            # Allow partial matches - query parts must match start of event parts
-            if len(event_parts) < len(parts):
-                continue
-                
-            match = True
-            for p1, p2 in zip(parts, event_parts):
-                if p1 == '*':
-                    continue
-                if '(' in p1:
-                    options = p1.strip('()').split('|')
-                    if p2 not in options:
-                        match = False
-                        break
-                elif p1 != p2:
-                    match = False
-                    break
-            
-            if match:
-                result.append(event)
-        return result
+        pattern = compile_query(query)
+        if events is not None:
+            return [event for event in events if match_query(pattern, event['event'].split('.'))]
+        if self._kept is not None and not self._covered(pattern):
+            # the events it asks for were dropped while streaming
+            raise ValueError(f'find_events("{query}") is not covered by the @reads queries of the parsers being run; '
+                             'add it to the @reads of the parser that uses it')
+
+        # walk down the index, expanding * and (a|b) into every matching prefix
+        positions, children = self._index
+        prefixes = [()]
+        for p in pattern:
+            if p is None:
+                prefixes = [prefix + (c,) for prefix in prefixes for c in children.get(prefix, ())]
+            elif isinstance(p, frozenset):
+                prefixes = [prefix + (c,) for prefix in prefixes for c in children.get(prefix, ()) if c in p]
+            else:
+                prefixes = [prefix + (p,) for prefix in prefixes if p in children.get(prefix, ())]
+
+        # events under different prefixes are disjoint, so merging keeps the original order
+        if len(prefixes) == 1:
+            hits = positions[prefixes[0]]
+        else:
+            hits = heapq.merge(*(positions[prefix] for prefix in prefixes))
+        return [self.events[i] for i in hits]
     
     # define one parser method for each data file you want to produce
     # csv_parser will produce a CSV, json_parser will produce JSON
     # it should either yield or return a list of entries (rows of a CSV)
     # the name of the file is taken from the method, e.g. trials -> trials.csv
     # for csv_parser, the keys of the yielded dicts will be the column names of the output CSV file
+    # add @on_event(query) below the parser decorator to handle one matching event at a time (see clicks)
+    # otherwise, list the queries the parser uses with @reads so that streamed events can be dropped early
     @csv_parser
+    @reads("timeline.end.instructions", "task")
     def trials(self):
         # Find when instructions end
         instruction_events = self.find_events("timeline.end.instructions")
@@ -94,19 +262,20 @@ class DataProcessor:
                 "end_time": end,
             }
 
-    @csv_parser 
-    def clicks(self):
-        for event in self.find_events("task.(hit|miss|timeout)"):
-            yield {
-                "wid": self.wid,
-                "trial_id": event.get('uniqueID'),
-                "timestamp": event.get('timestamp'),
-                "event_type": event['event'].split('.')[-1],
-                "x": event.get('x'),
-                "y": event.get('y')
-            }
+    @csv_parser
+    @on_event("task.(hit|miss|timeout)")
+    def clicks(self, event):
+        yield {
+            "wid": self.wid,
+            "trial_id": event.get('uniqueID'),
+            "timestamp": event.get('timestamp'),
+            "event_type": event['event'].split('.')[-1],
+            "x": event.get('x'),
+            "y": event.get('y')
+        }
 
     @json_parser
+    @reads("survey.done")
     def survey(self):
         for event in self.find_events("survey.done"):
             yield {
@@ -116,6 +285,7 @@ class DataProcessor:
             }
    
     @csv_parser
+    @reads("debrief.submitted")
     def debrief(self):
         event = self.find_events("debrief.submitted")[0]
         yield {
@@ -125,6 +295,7 @@ class DataProcessor:
         }
 
     @csv_parser
+    @reads("timeline")
     def timeline(self):
         starts = {}
         for event in self.find_events("timeline"):
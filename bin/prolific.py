@@ -3,12 +3,18 @@ import sys
 import subprocess
 import os
 import re
+import json
+import hashlib
+import shutil
 import requests
 from configparser import ConfigParser
 from markdown import markdown
 import random
 from fire import Fire
 from functools import cache, cached_property
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import time
 
 EXAMPLE_CONFIG = """
 [Prolific]
@@ -24,6 +30,29 @@ description =
 """
 
 
+API_URL = 'https://api.prolific.co/api/v1'
+
+
+class RateLimiter(object):
+    """Token bucket: allows bursts of up to `burst` requests, then `rate` per second."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last = time.monotonic()
+                self.tokens = 1
+            self.tokens -= 1
+
 
 class Prolific(object):
     """Prolific API wrapper and CLI interface.
@@ -38,7 +67,27 @@ class Prolific(object):
     - use `prolific.py pay
 
     """
-    def __init__(self, token=None):
+    # retry settings for transient errors (rate limiting, server hiccups)
+    max_retries = 5
+    retry_statuses = {429, 500, 502, 503, 504}
+    backoff = 1  # seconds, doubled on every attempt
+    max_backoff = 30
+    # stay comfortably below the API's rate limit
+    requests_per_second = 4
+    burst = 10
+    # number of requests to run in parallel when fetching many studies
+    max_workers = 8
+    # GET responses are cached on disk for this many seconds (first matching pattern wins)
+    cache_dir = '.prolific_cache'
+    cache_ttl = [
+        (r'/studies/\w+/submissions', 10 * 60),
+        (r'/projects/\w+/studies', 10 * 60),
+        (r'/studies/\w+/?$', 10 * 60),
+        (r'', 60),
+    ]
+
+    def __init__(self, token=None, refresh=False):
+        """Pass --refresh to ignore cached API responses."""
         super(Prolific, self).__init__()
         if token is None:
             token = find_token()
@@ -46,6 +95,16 @@ class Prolific(object):
             raise ValueError('You must provide a token, create a .prolific_token file, or set a PROLIFIC_TOKEN environment variable.')
 
         self.token = token
+        self.refresh = refresh
+        self.rate_limiter = RateLimiter(self.requests_per_second, self.burst)
+
+    @cached_property
+    def session(self):
+        # a shared session reuses connections across requests (keep-alive)
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16))
+        session.headers['Authorization'] = f'Token {self.token}'
+        return session
 
     @cached_property
     def project_id(self):
@@ -68,43 +127,114 @@ class Prolific(object):
                 print("Saved to .project_id - we won't ask again.")
             return project_id
 
-    def _request(self, method, url, json=None, **kws):
+    def _cache_file(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def _cached(self, url):
+        file = self._cache_file(url)
+        if self.refresh or not os.path.isfile(file):
+            return None
+        path = url.replace(API_URL, '').split('?')[0]
+        ttl = next(ttl for pattern, ttl in self.cache_ttl if re.search(pattern, path))
+        if time.time() - os.path.getmtime(file) > ttl:
+            return None
+        with open(file) as f:
+            return json.load(f)
+
+    def _save_cache(self, url, response):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        file = self._cache_file(url)
+        with open(file + '.tmp', 'w') as f:
+            json.dump(response, f)
+        os.replace(file + '.tmp', file)
+
+    def clear_cache(self):
+        """Delete all cached API responses."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self._studies.cache_clear()
+        self._submissions.cache_clear()
+
+    def _request(self, method, url, json=None, refresh=False, **kws):
         if url.startswith('/'):
-            url = 'https://api.prolific.co/api/v1' + url
+            url = API_URL + url
         if not url.endswith('/') and '?' not in url:  # adding / prevents redirecting POST requests
             url += '/'
-        r = requests.request(method, url, **kws, json=json, headers={
-            'Authorization': f'Token {self.token}',
-        })
-        response = r.json()
+
+        if method == 'GET' and not kws and not refresh:
+            response = self._cached(url)
+            if response is not None:
+                return response
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            try:
+                r = self.session.request(method, url, **kws, json=json, timeout=60)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # a POST might have gone through, so don't risk doing it twice
+                if method == 'POST' or attempt == self.max_retries:
+                    print(f'Problem with API request: {url}')
+                    print(e)
+                    exit(1)
+                retry_after = 0
+            else:
+                # 429 means the request was rejected, so it's safe to retry even a POST
+                retry = r.status_code == 429 or (r.status_code in self.retry_statuses and method != 'POST')
+                if r.ok or not retry or attempt == self.max_retries:
+                    break
+                retry_after = r.headers.get('Retry-After', '')
+                retry_after = int(retry_after) if retry_after.isdigit() else 0
+
+            delay = max(retry_after, random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            print(f'API request failed, retrying in {delay:.1f} seconds')
+            time.sleep(delay)
+
+        response = r.json() if r.content else None
+        if method != 'GET':
+            # anything that changes state (approving, bonusing, PATCH, ...) can make cached responses stale
+            self.clear_cache()
         if r.ok:
+            if method == 'GET' and not kws:
+                self._save_cache(url, response)
             return response
         else:
             print(f'Problem with API request: {url}')
             print(response)
             exit(1)
 
+    def _paginate(self, url, refresh=False):
+        """GET all results from a list endpoint, following the `next` links."""
+        results = []
+        while url:
+            res = self._request('GET', url, refresh=refresh)
+            results.extend(res['results'])
+            url = ((res.get('_links') or {}).get('next') or {}).get('href')
+        count = (res.get('meta') or {}).get('count')
+        if count is not None and len(results) != count:
+            print(f"WARNING: expected {count} results but got {len(results)}")
+        return results
+
     @cache
     def _studies(self):
-        res = self._request('GET', f'/projects/{self.project_id}/studies?limit=1000')
-        if len(res['results']) != res['meta']['count']:
-            print("Some studies were not retrieved. You might have to implemnent paging.")
-
-        return [s for s in res['results'] if s['status'] != 'UNPUBLISHED' ]
+        studies = self._paginate(f'/projects/{self.project_id}/studies?limit=1000')
+        return [s for s in studies if s['status'] != 'UNPUBLISHED' ]
 
     @cache
-    def _submissions(self, study_id):
-        res = self._request('GET', f'/studies/{study_id}/submissions?limit=1000')
-        if len(res['results']) != res['meta']['count']:
-            print("Some submissions were not retrieved. You might have to implemnent paging.")
-            exit(1)
-        return res['results']
+    def _submissions(self, study_id, refresh=False):
+        # anything that pays people passes refresh=True: a cached list could miss
+        # bonuses paid in the meantime (e.g. on the website), and we'd pay them again
+        return self._paginate(f'/studies/{study_id}/submissions?limit=1000', refresh)
+
+    def _all_submissions(self, study_ids, refresh=False):
+        """Fetch the submissions for many studies at once, returning a list in the same order."""
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            return list(pool.map(lambda study_id: self._submissions(study_id, refresh=refresh), study_ids))
 
     def summary_csv(self):
         """Generates a summary of all participants for this project"""
         records = []
-        for study in self._studies():
-            for sub in self._submissions(study['id']):
+        studies = self._studies()
+        for study, submissions in zip(studies, self._all_submissions([s['id'] for s in studies])):
+            for sub in submissions:
 
                 records.append({
                     'internal_name': study['internal_name'],
@@ -124,12 +254,8 @@ class Prolific(object):
         pd.DataFrame(records).to_csv('prolific_summary.csv')
 
 
-    def approve(self, study=0, ignore_code=False):
-        """Approve all submissions of the last study.
-
-        The "last" study refers to the most recently posted study within your project.
-        """
-        study_id = self.study_id(study)
+    def _pending_approvals(self, study_id, ignore_code=False):
+        """Participants awaiting review, split into (correct code, incorrect code)."""
         to_approve = []
         bad_code = []
         completion_codes = [x['code']
@@ -137,46 +263,44 @@ class Prolific(object):
             if x['code_type'] == "COMPLETED"
         ]
 
-        for sub in self._submissions(study_id):
+        for sub in self._submissions(study_id, refresh=True):
             if sub['status'] != 'AWAITING REVIEW':
                 continue
             if ignore_code or sub['study_code'] in completion_codes:
                 to_approve.append(sub["participant_id"])
             else:
                 bad_code.append(sub["participant_id"])
+        return to_approve, bad_code
+
+    def _approve(self, study_id, to_approve):
+        self._request('POST', "/submissions/bulk-approve/", {
+            "study_id": study_id,
+            "participant_ids": to_approve
+        })
 
+    def approve(self, study=0, ignore_code=False):
+        """Approve all submissions of the last study.
+
+        The "last" study refers to the most recently posted study within your project.
+        """
+        study_id = self.study_id(study)
+        to_approve, bad_code = self._pending_approvals(study_id, ignore_code)
 
         if bad_code:
             print(f'{len(bad_code)} submissions have an incorrect code. Check',
                 f"https://app.prolific.co/researcher/workspaces/studies/{study_id}/submissions")
 
         if to_approve:
-            self._request('POST', "/submissions/bulk-approve/", {
-                "study_id": study_id,
-                "participant_ids": to_approve
-            })
+            self._approve(study_id, to_approve)
             print(f'Approved {len(to_approve)} submissions')
         else:
             print('No submissions to approve')
 
-    def assign_bonuses(self, study=0, bonuses='bonus.json'):
-        """Assign bonuses for the last study, specified in a dictionary or file.
-
-        By default, it will read bonus.json, with workerid keys and bonus_in_dollars values. This
-        file is generated when you run bin/fetch_data.py.
-        A csv file is also allowed, with format workerid,bonus_in_dollars (no header).
-
-        If a worker has already received a bonus, then they will only be bonused if bonus_in_dollars
-        is more than their current bonus (to reach the target bonus amount). It is safe to run this
-        command many times for the same study.
-        """
-        study_id = self.study_id(study)
-
+    def _load_bonuses(self, bonuses):
         if isinstance(bonuses, str):
             file = bonuses
 
             if file.endswith('.json'):
-                import json
                 with open(file) as f:
                     bonuses = json.load(f)
 
@@ -185,33 +309,64 @@ class Prolific(object):
                 bonuses = dict(pd.read_csv(file, header=None).set_index(0)[1])
 
         assert isinstance(bonuses, dict)
+        return bonuses
 
-        previous_bonus = {sub['participant_id']: sum(sub['bonus_payments']) / 100
-                          for sub in self._submissions(study_id)}
+    def _bonuses_due(self, study_ids, bonuses):
+        """Additional bonus owed to each participant to reach their target bonus, for each study.
 
-        # n_bonused = sum(previous_bonus > 0)
-        # if n_bonused:
-        #     print(f'{n_bonused} participants already have bonuses, {len(bonuses) - n_bonused} to be bonused')
-        participants = previous_bonus.keys()
+        Bonuses already paid are summed over all the studies, and anything still owed
+        is assigned to the first study in study_ids that the participant took part in,
+        so a participant in several studies is never paid the target more than once.
+        """
+        previous_bonus = {}
+        first_study = {}
+        for study_id, submissions in zip(study_ids, self._all_submissions(study_ids, refresh=True)):
+            for sub in submissions:
+                p = sub['participant_id']
+                previous_bonus[p] = previous_bonus.get(p, 0) + sum(sub['bonus_payments']) / 100
+                first_study.setdefault(p, study_id)
+
+        due = {study_id: {} for study_id in study_ids}
+        for p, study_id in first_study.items():
+            bonus = round(bonuses.get(p, 0) - previous_bonus[p], 2)
+            if bonus > 0:
+                due[study_id][p] = bonus
+        return [due[study_id] for study_id in study_ids]
+
+    def _create_bonus_payment(self, study_id, due):
+        """Set up (but don't pay) a bulk bonus payment; returns the API response."""
+        return self._request('POST', '/submissions/bonus-payments/', {
+            'study_id': study_id,
+            'csv_bonuses': '\n'.join(f'{p},{bonus:.2f}' for p, bonus in due.items())
+        })
+
+    def _warn_missing(self, bonuses, participants):
         missing = set(bonuses.keys()) - set(participants)
         if missing:
             print('WARNING: some entries of bonuses.csv do not have submissions. Skipping these.')
             print('\n'.join(f'{p},{bonus:.2f}' for p, bonus in bonuses.items() if p in missing))
             print()
 
-        new_bonus = {
-            p: bonuses.get(p, 0) - previous_bonus[p] for p in participants
-        }
-        bonus_string = '\n'.join(f'{p},{bonus:.2f}' for p, bonus in new_bonus.items() if bonus > 0)
+    def assign_bonuses(self, study=0, bonuses='bonus.json'):
+        """Assign bonuses for the last study, specified in a dictionary or file.
+
+        By default, it will read bonus.json, with workerid keys and bonus_in_dollars values. This
+        file is generated when you run bin/fetch_data.py.
+        A csv file is also allowed, with format workerid,bonus_in_dollars (no header).
+
+        If a worker has already received a bonus, then they will only be bonused if bonus_in_dollars
+        is more than their current bonus (to reach the target bonus amount). It is safe to run this
+        command many times for the same study.
+        """
+        study_id = self.study_id(study)
+        bonuses = self._load_bonuses(bonuses)
+        self._warn_missing(bonuses, [sub['participant_id'] for sub in self._submissions(study_id, refresh=True)])
+        due = self._bonuses_due([study_id], bonuses)[0]
 
-        if not bonus_string:
+        if not due:
             print('No bonuses due')
         else:
-            resp = self._request('POST', '/submissions/bonus-payments/', {
-                'study_id': study_id,
-                'csv_bonuses': bonus_string
-            })
-
+            resp = self._create_bonus_payment(study_id, due)
             amt = resp['total_amount'] / 100
             yes = input(f'Pay ${amt:.2f} in bonuses? [N/y]: ')
             if yes == 'y':
@@ -225,11 +380,52 @@ class Prolific(object):
         self.approve(study)
         self.assign_bonuses(study, bonuses)
 
-    def pay_all(self, n=10):
-        """Approve and bonus the last n (default 10) studies. Will not double-bonus."""
-        for i in range(n):
-            self.approve(i)
-            self.assign_bonuses(i, bonuses)
+    def pay_all(self, n=10, bonuses='bonus.json', ignore_code=False):
+        """Approve and bonus the last n (default 10) studies. Will not double-bonus.
+
+        Everything that is due is collected first (in parallel), then you confirm
+        once for all the studies, and the approvals and payments are submitted together.
+        """
+        studies = self._studies()[-n:][::-1]
+        bonuses = self._load_bonuses(bonuses)
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            approvals = list(pool.map(lambda study: self._pending_approvals(study['id'], ignore_code), studies))
+            # anyone in several of the studies is bonused through the most recent one
+            due = self._bonuses_due([s['id'] for s in studies], bonuses)
+            plans = [(to_approve, bad_code, d) for (to_approve, bad_code), d in zip(approvals, due)]
+            participants = [sub['participant_id'] for subs in self._all_submissions([s['id'] for s in studies], refresh=True) for sub in subs]
+            self._warn_missing(bonuses, participants)
+
+            # bonus payments are only set up here; nothing is paid until we confirm below
+            payments = list(pool.map(
+                lambda study, plan: self._create_bonus_payment(study['id'], plan[2]) if plan[2] else None,
+                studies, plans
+            ))
+
+        print(f"{'study':40} {'approve':>8} {'bad code':>8} {'bonuses':>8} {'amount':>9}")
+        for study, (to_approve, bad_code, due), payment in zip(studies, plans, payments):
+            amt = payment['total_amount'] / 100 if payment else 0
+            print(f"{study['internal_name'][:40]:40} {len(to_approve):8} {len(bad_code):8} {len(due):8} {f'${amt:.2f}':>9}")
+        n_approve = sum(len(plan[0]) for plan in plans)
+        total = sum(payment['total_amount'] for payment in payments if payment) / 100
+        print(f"{'TOTAL':40} {n_approve:8} {sum(len(plan[1]) for plan in plans):8} "
+              f"{sum(len(plan[2]) for plan in plans):8} {f'${total:.2f}':>9}")
+
+        if not n_approve and not total:
+            print('Nothing to do')
+            return
+        yes = input(f'Approve {n_approve} submissions and pay ${total:.2f} in bonuses? [N/y]: ')
+        if yes != 'y':
+            print('NOT approving or paying')
+            return
+
+        jobs = [(self._approve, study['id'], plan[0]) for study, plan in zip(studies, plans) if plan[0]]
+        jobs += [(self._request, 'POST', f'/bulk-bonus-payments/{payment["id"]}/pay/')
+                 for payment in payments if payment]
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            list(pool.map(lambda job: job[0](*job[1:]), jobs))
+        print(f'Approved {n_approve} submissions and paid ${total:.2f} in bonuses')
 
     def update_places(self, new_total, study=0):
         """Set the total number of participants for the last study to `new_total`
@@ -353,51 +549,105 @@ class Prolific(object):
             if confirm.lower() == 'n':
                 self._request('DELETE', '/studies/' + new['id'])
 
-    def check_wage(self, study=0, target_wage=12):
-        """Summarizes time and total payment for the given study"""
-        study_id = self.study_id(study)
-        from dateutil.parser import parse
-        import numpy as np
+    def check_wage(self, study=0, target_wage=12, n=1, bootstrap=1000):
+        """Summarizes time and total payment for the given study
 
-        basepay = self._request('GET', f'/studies/{study_id}')['reward']
+        With n > 1, each of the n studies starting from `study` is summarized,
+        followed by all of them pooled together. Ranges are bootstrapped 95% CIs.
+        """
+        import numpy as np
+        import pandas as pd
 
-        times = []
-        pays = []
-        for sub in self._request('GET', f'/studies/{study_id}/submissions')['results']:
-            if not sub['is_complete']:
-                continue
-            seconds = (parse(sub['completed_at']) - parse(sub['started_at'])).total_seconds()
-            hrs = seconds / 3600
-            times.append(hrs)
-            bonus = sum(sub['bonus_payments'])
-            totalpay = (basepay + bonus) / 100
-            pays.append(totalpay)
+        study_ids = [study] if isinstance(study, str) else [self.study_id(study + i) for i in range(n)]
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            details = list(pool.map(lambda s: self._request('GET', f'/studies/{s}'), study_ids))
+        all_submissions = self._all_submissions(study_ids)
 
-        pays = np.array(pays)
-        times = np.array(times)
+        records = []
+        for study_id, detail, submissions in zip(study_ids, details, all_submissions):
+            for sub in submissions:
+                if sub['is_complete']:
+                    records.append({
+                        'study_id': study_id,
+                        'study': detail['internal_name'],
+                        'basepay': detail['reward'],
+                        'bonus': sum(sub['bonus_payments']),
+                        'started_at': sub['started_at'],
+                        'completed_at': sub['completed_at'],
+                    })
+        if not records:
+            print('No completed submissions')
+            return
+        df = pd.DataFrame(records)
+        df['hours'] = (pd.to_datetime(df.completed_at, utc=True) - pd.to_datetime(df.started_at, utc=True)).dt.total_seconds() / 3600
+        df['pay'] = (df.basepay + df.bonus) / 100
+
+        # internal names aren't unique, so group by id and only use the name as a label
+        groups = [(f'{g.study.iloc[0]} [{study_id}]', g) for study_id, g in df.groupby('study_id', sort=False)]
+        groups = groups if len(study_ids) > 1 else []
+        groups.append(('ALL STUDIES' if groups else None, df))
 
         try:
             import uniplot
-            uniplot.plot(pays, 60*times, x_unit=" min", y_unit=" $", title="Pay by Time")
+            uniplot.plot(df.pay.values, 60*df.hours.values, x_unit=" min", y_unit=" $", title="Pay by Time")
         except ImportError:
             print('pip install uniplot to get a nice plot here')
 
-        print(f'median time is: {60*np.median(times):.2f} minutes')
-        print(f'average pay is: ${np.median(pays):.2f}')
-        print(f'median wage is: ${np.median(pays / times):.2f}/hr')
-
-        inc = np.arange(-5, 5, .05).reshape((-1, 1))
-        W = (pays + inc) / times
-        i = np.argmax(np.median(W, axis=1) > target_wage)
-
-        missing_base = round(inc[i][0], 2)
-        new_base = (basepay / 100) + inc[i][0]
-        print(f'base pay is off by ${-missing_base:+.2f}, should be ${new_base:.2f}')
+        rng = np.random.default_rng()
+        for name, g in groups:
+            pays = g.pay.values
+            times = g.hours.values
+            idx = rng.integers(0, len(g), size=(bootstrap, len(g)))
+            boot_pays, boot_times = pays[idx], times[idx]
+
+            def ci(stat):
+                lo, hi = np.percentile(stat, [2.5, 97.5])
+                return f'({lo:.2f} to {hi:.2f})'
+
+            if name:
+                print(f'\n{name} ({len(g)} submissions)')
+            print(f'median time is: {60*np.median(times):.2f} minutes {ci(60*np.median(boot_times, axis=1))}')
+            print(f'median pay is: ${np.median(pays):.2f} {ci(np.median(boot_pays, axis=1))}')
+            print(f'median wage is: ${np.median(pays / times):.2f}/hr {ci(np.median(boot_pays / boot_times, axis=1))}')
+
+            missing_base = median_wage_adjustment(pays, times, target_wage)
+            boot_missing = median_wage_adjustment(boot_pays, boot_times, target_wage)
+            if g.basepay.nunique() == 1:
+                new_base = g.basepay.iloc[0] / 100 + missing_base
+                print(f'base pay is off by ${-missing_base:+.2f}, should be ${new_base:.2f} '
+                      f'{ci(g.basepay.iloc[0] / 100 + boot_missing)}')
+            else:
+                print(f'base pay is off by ${-missing_base:+.2f} {ci(-boot_missing)}')
 
     def add_places(self, study_id, new_total):
         self._request('PATCH', f'/studies/{study_id}/', dict(total_available_places=new_total))
 
 
+def median_wage_adjustment(pays, times, target_wage):
+    """The change in pay that would make the median of (pays + change) / times equal target_wage.
+
+    The last axis indexes participants; any leading axes (e.g. bootstrap samples) are batched.
+    """
+    import numpy as np
+    # d[i] is the change at which participant i would earn exactly the target wage
+    d = np.sort(target_wage * times - pays, axis=-1)
+    n = d.shape[-1]
+    k = n // 2
+    if n % 2:
+        # at least k+1 wages reach the target exactly when the change is at least
+        # the (k+1)th smallest d, so that is the exact solution
+        return d[..., k]
+
+    # with an even number, the median averages two wages; it reaches the target
+    # somewhere between these two values of d, so bisect
+    lo, hi = d[..., max(k - 2, 0)], d[..., k]
+    for _ in range(50):
+        mid = (lo + hi) / 2
+        low = np.median((pays + mid[..., None]) / times, axis=-1) < target_wage
+        lo = np.where(low, mid, lo)
+        hi = np.where(low, hi, mid)
+    return (lo + hi) / 2
+
 def find_token():
     if os.path.isfile(".prolific_token"):
         with open('.prolific_token') as f:
@@ -1,24 +1,36 @@
 # this file imports custom routes into the experiment server
 
-from flask import Blueprint, render_template, request, jsonify, Response, abort, current_app, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, Response, abort, current_app, redirect, url_for, stream_with_context, g, has_request_context
 from jinja2 import TemplateNotFound
 from functools import wraps
-from sqlalchemy import or_
+from itertools import islice
+from sqlalchemy import or_, func, exc, event
+from sqlalchemy.orm import defer
 from traceback import format_exc
+import csv
+import datetime
+import io
+import time
+import zlib
 
 from psiturk.psiturk_config import PsiturkConfig
 from psiturk.experiment_errors import ExperimentError, InvalidUsage
 from psiturk.user_utils import PsiTurkAuthorization, nocache
 
 # # Database setup
-from psiturk.db import db_session, init_db
+from psiturk.db import db_session, init_db, engine
 from psiturk.models import Participant
 from json import dumps, loads
+import datastore
+import deltas
+from metrics import Metrics
 
 # load the configuration options
 config = PsiturkConfig()
 config.load_config()
 myauth = PsiTurkAuthorization(config)  # if you want to add a password protect route use this
+# store new datastrings compressed (see datastore.py); old rows are read either way
+COMPRESS_DATASTRINGS = config.getboolean('Database Parameters', 'compress_datastrings', fallback=False)
 
 # explore the Blueprint
 custom_code = Blueprint('custom_code', __name__, template_folder='templates', static_folder='static')
@@ -34,6 +46,74 @@ QUITEARLY = 6
 BONUSED = 7
 BAD = 8
 
+#----------------------------------------------
+# request timing and metrics
+#----------------------------------------------
+# Latency, payload sizes and query counts for every route (including psiturk's
+# own) are collected in metrics.py and served at /metrics. With server_timing
+# = true in config.txt, every response also gets a Server-Timing header with
+# the milliseconds spent in the database and in total, e.g. "db;dur=3.1,
+# total;dur=12.4". Browsers show it in the network tab, and bin/loadtest.py
+# uses it to report DB time per route.
+
+metrics = Metrics()
+SERVER_TIMING = config.getboolean('Server Parameters', 'server_timing', fallback=False)
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context():
+        g.db_time = g.get('db_time', 0) + elapsed
+        g.db_queries = g.get('db_queries', 0) + 1
+
+@custom_code.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@custom_code.after_app_request
+def record_request(response):
+    if 'request_start' not in g:
+        return response
+    if SERVER_TIMING:
+        # for streamed responses (e.g. /data) this only covers the time before the body
+        response.headers['Server-Timing'] = 'db;dur=%.1f, total;dur=%.1f' % (
+            1000 * g.get('db_time', 0), 1000 * (time.perf_counter() - g.request_start))
+
+    # the request context may be gone by the time a streamed body finishes
+    state = g._get_current_object()
+    labels = (request.method, request.url_rule.rule if request.url_rule else 'unmatched', response.status_code)
+    request_bytes = request.content_length or 0
+    def finish(response_bytes):
+        metrics.observe(*labels, time.perf_counter() - state.request_start, request_bytes,
+                        response_bytes, getattr(state, 'db_queries', 0), getattr(state, 'db_time', 0))
+
+    if response.content_length is not None:
+        finish(response.content_length)
+    else:
+        response.response = counted(response.response, finish)
+    return response
+
+def counted(body, finish):
+    n = 0
+    try:
+        for chunk in body:
+            n += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        finish(n)
+        if hasattr(body, 'close'):
+            body.close()
+
+@custom_code.route('/metrics')
+@myauth.requires_auth
+def show_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @custom_code.route('/')
 def demo():
     data = {
@@ -68,38 +148,257 @@ def get_participants(codeversion):
     )
 
 
+# Rows of the CSV files served by /data, in the same format as psiturk's
+# Participant.get_trial_data etc. Each takes a uniqueid and a decoded datastring.
+
+def trialdata_rows(uniqueid, data):
+    for trial in data["data"]:
+        yield uniqueid, trial["current_trial"], trial["dateTime"], dumps(trial["trialdata"])
+
+def eventdata_rows(uniqueid, data):
+    for ev in data["eventdata"]:
+        yield uniqueid, ev["eventtype"], ev["interval"], ev["value"], ev["timestamp"]
+
+def questiondata_rows(uniqueid, data):
+    for question, answer in data["questiondata"].items():
+        yield uniqueid, question, answer
+
+
 @custom_code.route('/data/<codeversion>/<name>', methods=['GET'])
 @myauth.requires_auth
 @nocache
 def download_datafiles(codeversion, name):
     contents = {
-        "trialdata": lambda p: p.get_trial_data(),
-        "eventdata": lambda p: p.get_event_data(),
-        "questiondata": lambda p: p.get_question_data()
+        "trialdata": trialdata_rows,
+        "eventdata": eventdata_rows,
+        "questiondata": questiondata_rows,
     }
 
     if name not in contents:
         abort(404)
+    rows = contents[name]
+
+    # only load the columns we need, and fetch them in batches through a
+    # server-side cursor so that memory doesn't grow with the number of participants
+    query = (
+        db_session.query(Participant.uniqueid, Participant.datastring)
+        .filter(Participant.codeversion == codeversion)
+        .execution_options(stream_results=True)
+        .yield_per(50)
+    )
+
+    def participants():
+        # the saves that haven't been folded into the datastring yet (see
+        # deltas.py) are fetched for a batch of participants at a time
+        results = iter(query)
+        while True:
+            batch = list(islice(results, 50))
+            if not batch:
+                return
+            pending = deltas.load([uniqueid for uniqueid, _ in batch])
+            for uniqueid, datastring in batch:
+                if datastring is None and uniqueid not in pending:
+                    continue
+                yield uniqueid, datastring, pending.get(uniqueid, [])
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for uniqueid, datastring, pending in participants():
+            try:
+                data = loads(datastore.decode(datastring)) if datastring is not None else {}
+                for row in rows(uniqueid, deltas.assemble(data, pending)):
+                    writer.writerow(row)
+            except (TypeError, ValueError, KeyError):
+                current_app.logger.error("Error loading {} for {}".format(name, uniqueid))
+                current_app.logger.error(format_exc())
+                buffer.seek(0)  # skip this participant entirely, like psiturk does
+            else:
+                yield buffer.getvalue()
+                buffer.seek(0)
+            buffer.truncate()
+
+    headers = {'Content-Disposition': 'attachment;filename=%s.csv' % name, 'Vary': 'Accept-Encoding'}
+    body = generate()
+    if request.accept_encodings['gzip']:
+        headers['Content-Encoding'] = 'gzip'
+        body = gzip_stream(body)
+    return Response(stream_with_context(body), content_type="text/csv", headers=headers)
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: write a gzip header
+    for chunk in chunks:
+        out = compressor.compress(chunk.encode('utf-8'))
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+#----------------------------------------------
+# incremental data saving
+#----------------------------------------------
+# The stock psiturk client PUTs the whole datastring to /sync on every save,
+# which gets expensive late in a long session. Our psiturk.js instead sends
+# only the trials/events recorded since the last acknowledged save, along with
+# the index of the first one (dataStart and eventdataStart). Anything the
+# server already has is dropped, so retrying a save is harmless. When the
+# browser supports it, the body is also gzipped (Content-Encoding: gzip).
+#
+# Each save is stored as its own row in a side table (see deltas.py) rather
+# than by rewriting the participant's datastring, so a save costs the same at
+# the end of a session as at the start. Readers (load_delta, /data and
+# bin/fetch_data.py) put the datastring back together, and /complete_exp
+# folds the rows into it once. Don't mix this with psiturk's own /sync route
+# for the same participant, which rewrites the datastring without knowing
+# about the rows.
+
+APPENDED_KEYS = deltas.APPENDED_KEYS
+MAX_SYNC_BYTES = 64 * 1024 * 1024  # decompressed; guards against gzip bombs
+
+def update_aggregates(aggregates, trial):
+    # Running per-participant summaries, updated as each new trial arrives so
+    # that we never have to walk the whole datastring. They are stored with
+    # each saved delta (and under "aggregates" in the datastring), and the
+    # bonus (if set) is also kept in the participant's bonus column (see
+    # compute_bonus). Edit for your experiment.
+    aggregates['n_trials'] = aggregates.get('n_trials', 0) + 1
+    if trial.get('phase') == 'TEST' and trial.get('hit') == True:
+        aggregates['bonus'] = round(aggregates.get('bonus', 0) + 0.02, 2)
 
-    query = get_participants(codeversion)
-    data = []
-    for p in query:
+def aggregate_records(aggregates, records):
+    for record in records:
+        trial = record.get('trialdata') if isinstance(record, dict) else None
+        if isinstance(trial, dict):  # psiturk allows any JSON here
+            update_aggregates(aggregates, trial)
+    aggregates['n_records'] = aggregates.get('n_records', 0) + len(records)
+
+def current_aggregates(data):
+    # The aggregates are rebuilt from the stored trials if they're missing or
+    # don't cover every trial: rows saved before they existed, or datastrings
+    # written by psiturk's own /sync route.
+    aggregates = data.get('aggregates')
+    records = data.get('data') or []
+    if not isinstance(aggregates, dict) or aggregates.get('n_records') != len(records):
+        aggregates = data['aggregates'] = {}
+        aggregate_records(aggregates, records)
+    return aggregates
+
+def request_json():
+    body = request.get_data()
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        decompressor = zlib.decompressobj(31)  # 31: expect a gzip header
         try:
-            data.append(contents[name](p))
-        except TypeError:
-            current_app.logger.error("Error loading {} for {}".format(name, p))
+            body = decompressor.decompress(body, MAX_SYNC_BYTES)
+        except zlib.error:
+            raise InvalidUsage('could not decompress request body')
+        if decompressor.unconsumed_tail:
+            raise InvalidUsage('request body too large', status_code=413)
+    try:
+        return loads(body)
+    except ValueError:
+        return None
+
+def load_datastring(user):
+    try:
+        return loads(datastore.decode(user.datastring))
+    except (TypeError, ValueError):
+        if user.datastring is not None:
+            current_app.logger.error("Could not load datastring for %s", user.uniqueid)
             current_app.logger.error(format_exc())
-            
-    # current_app.logger.critical('data %s', data)
-    ret = "".join(data)
-    response = Response(
-        ret,
-        content_type="text/csv",
-        headers={
-            'Content-Disposition': 'attachment;filename=%s.csv' % name
-        })
+        return {
+            "condition": user.cond,
+            "counterbalance": user.counterbalance,
+            "assignmentId": user.assignmentid,
+            "workerId": user.workerid,
+            "hitId": user.hitid,
+            "bonus": user.bonus
+        }
 
-    return response
+
+def load_assembled(user):
+    return deltas.assemble(load_datastring(user), deltas.load([user.uniqueid])[user.uniqueid])
+
+
+@custom_code.route('/sync_delta/<uid>', methods=['GET'])
+def load_delta(uid):
+    user = Participant.query.filter(Participant.uniqueid == uid).one_or_none()
+    if user is None:
+        abort(404)
+    return jsonify(**load_assembled(user))
+
+
+@custom_code.route('/sync_delta/<uid>', methods=['PUT'])
+def save_delta(uid):
+    delta = request_json()
+    if not isinstance(delta, dict):
+        raise InvalidUsage('expected a JSON object')
+
+    starts = {key: delta.pop(key + 'Start', 0) for key in APPENDED_KEYS}
+    for key in APPENDED_KEYS:
+        if type(starts[key]) is not int or starts[key] < 0:
+            raise InvalidUsage(f'{key}Start must be a non-negative integer')
+        if not isinstance(delta.get(key, []), list):
+            raise InvalidUsage(f'{key} must be a list')
+
+    # lock the row so that overlapping saves can't drop each other's records
+    user = Participant.query.filter(Participant.uniqueid == uid).with_for_update().one_or_none()
+    if user is None:
+        abort(404)
+
+    last = deltas.latest(uid)
+    if last is None:
+        # first save through here; start from whatever the datastring has
+        data = load_datastring(user)
+        aggregates = current_aggregates(data)
+        counts = {key: len(data.get(key) or []) for key in APPENDED_KEYS}
+        seq = 0
+    else:
+        aggregates = loads(last.aggregates)
+        counts = last.counts()
+        seq = last.seq + 1
+
+    if any(starts[key] > counts[key] for key in APPENDED_KEYS):
+        # we never received some earlier records; client should resend from counts
+        db_session.rollback()
+        current_app.logger.warning("sync_delta gap for %s: got %s, have %s", uid, starts, counts)
+        return jsonify(status="missing records", **counts), 409
+
+    for key in APPENDED_KEYS:
+        new = delta[key] = delta.get(key, [])[counts[key] - starts[key]:]
+        counts[key] += len(new)
+        if key == 'data':
+            aggregate_records(aggregates, new)
+    if 'bonus' in aggregates:  # otherwise leave whatever else set it alone
+        user.bonus = aggregates['bonus']
+    delta.pop('aggregates', None)  # the server owns these
+
+    db_session.add(deltas.Delta(
+        uniqueid=uid, seq=seq, data_end=counts['data'], eventdata_end=counts['eventdata'],
+        aggregates=dumps(aggregates), delta=datastore.encode(dumps(delta), COMPRESS_DATASTRINGS),
+    ))
+    db_session.add(user)
+    db_session.commit()
+
+    current_app.logger.info("saved data for %s (%s)", uid, counts)
+    return jsonify(status="user data saved", **counts)
+
+
+def fold_deltas(user):
+    # Write the saved deltas into the datastring, leaving a checkpoint row so
+    # that later saves and compute_bonus still find the counts and aggregates.
+    # Call with the participant's row locked.
+    rows = deltas.load([user.uniqueid])[user.uniqueid]
+    if not any(row.delta is not None for row in rows):
+        return
+    data = deltas.assemble(load_datastring(user), rows)
+    last = rows[-1]
+    user.datastring = datastore.encode(dumps(data), COMPRESS_DATASTRINGS)
+    deltas.Delta.query.filter(deltas.Delta.uniqueid == user.uniqueid).delete()
+    db_session.add(deltas.Delta(
+        uniqueid=user.uniqueid, seq=last.seq + 1, data_end=last.data_end,
+        eventdata_end=last.eventdata_end, aggregates=last.aggregates, delta=None,
+    ))
 
 
 @custom_code.route('/complete_exp', methods=['POST'])
@@ -111,14 +410,15 @@ def complete_exp():
     current_app.logger.info("completed experimente")
     try:
         user = Participant.query.\
-            filter(Participant.uniqueid == unique_id).one()
+            filter(Participant.uniqueid == unique_id).with_for_update().one()
+        fold_deltas(user)
         user.status = COMPLETED
         user.endhit = datetime.datetime.now()
         db_session.add(user)
         db_session.commit()
         resp = {"status": "success"}
     except exc.SQLAlchemyError:
-        app.logger.error("DB error: Unique user not found.")
+        current_app.logger.error("DB error: Unique user not found.")
         resp = {"status": "error, uniqueId not found"}
     return jsonify(**resp)
 
@@ -148,12 +448,46 @@ def my_password_protected_route():
 #----------------------------------------------
 # example accessing data
 #----------------------------------------------
+STATUS_NAMES = {
+    NOT_ACCEPTED: 'not accepted', ALLOCATED: 'allocated', STARTED: 'started',
+    COMPLETED: 'completed', SUBMITTED: 'submitted', CREDITED: 'credited',
+    QUITEARLY: 'quit early', BONUSED: 'bonused', BAD: 'bad',
+}
+
 @custom_code.route('/view_data')
 @myauth.requires_auth
 def list_my_data():
-    users = Participant.query.all()
+    # e.g. /view_data?codeversion=v1.0&status=3&page=2
+    codeversion = request.args.get('codeversion')
+    status = request.args.get('status', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = max(min(request.args.get('per_page', 100, type=int), 1000), 1)
+
+    # never load the (potentially huge) datastrings for this page
+    query = Participant.query.options(defer(Participant.datastring))
+    if codeversion:
+        query = query.filter(Participant.codeversion == codeversion)
+
+    # counts are computed by the database
+    versions = (
+        db_session.query(Participant.codeversion, func.count())
+        .group_by(Participant.codeversion).order_by(Participant.codeversion).all()
+    )
+    statuses = query.with_entities(Participant.status, func.count()).group_by(Participant.status).all()
+
+    if status is not None:
+        query = query.filter(Participant.status == status)
+    total = query.order_by(None).count()
+    users = (
+        query.order_by(Participant.beginhit.desc())
+        .offset((page - 1) * per_page).limit(per_page).all()
+    )
     try:
-        return render_template('list.html', participants=users)
+        return render_template(
+            'list.html', participants=users, total=total, page=page, per_page=per_page,
+            codeversion=codeversion, status=status, versions=versions, statuses=statuses,
+            status_names=STATUS_NAMES,
+        )
     except TemplateNotFound:
         abort(404)
 
@@ -166,28 +500,33 @@ def compute_bonus():
     # check that user provided the correct keys
     # errors will not be that gracefull here if being
     # accessed by the Javascrip client
-    if not request.args.has_key('uniqueId'):
+    if 'uniqueId' not in request.args:
         raise ExperimentError('improper_inputs')  # i don't like returning HTML to JSON requests...  maybe should change this
     uniqueId = request.args['uniqueId']
 
-    try:
-        # lookup user in database
+    # The bonus column is kept up to date by update_aggregates as data is
+    # saved, so it can be returned as is. Participants who were never saved
+    # through /sync_delta (no rows in deltas.py, e.g. psiturk's own /sync)
+    # have their trials walked once, and get a checkpoint row so it isn't
+    # done again.
+    user = Participant.query.\
+           filter(Participant.uniqueid == uniqueId).one_or_none()
+    if user is None:
+        abort(404)  # again, bad to display HTML, but...
+    if deltas.latest(uniqueId) is None:
         user = Participant.query.\
                filter(Participant.uniqueid == uniqueId).\
-               one()
-        user_data = loads(user.datastring) # load datastring from JSON
-        bonus = 0
-
-        for record in user_data['data']: # for line in data file
-            trial = record['trialdata']
-            if trial['phase']=='TEST':
-                if trial['hit']==True:
-                    bonus += 0.02
-        user.bonus = bonus
-        db_session.add(user)
+               with_for_update().populate_existing().one()
+        if deltas.latest(uniqueId) is None:  # unless a save got there first
+            data = load_datastring(user)
+            aggregates = current_aggregates(data)
+            db_session.add(deltas.Delta(
+                uniqueid=uniqueId, seq=0, data_end=len(data.get('data') or []),
+                eventdata_end=len(data.get('eventdata') or []), aggregates=dumps(aggregates), delta=None,
+            ))
+            if 'bonus' in aggregates:
+                user.bonus = aggregates['bonus']
+            db_session.add(user)
         db_session.commit()
-        resp = {"bonusComputed": "success"}
-        return jsonify(**resp)
-    except:
-        abort(404)  # again, bad to display HTML, but...
-
+    resp = {"bonusComputed": "success", "bonus": user.bonus}
+    return jsonify(**resp)
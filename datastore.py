@@ -0,0 +1,34 @@
+# Encoding of participant datastrings in the database.
+#
+# Datastrings can optionally be stored compressed: zlib, then base64 so that
+# it still fits in a text column, behind a short prefix saying how it was
+# encoded. Anything without a known prefix is plain JSON (all the rows saved
+# before compression was turned on, and anything psiturk itself writes).
+# Used by custom.py and bin/fetch_data.py.
+
+import base64
+import binascii
+import zlib
+
+PREFIX = 'z1:'  # bump the number if the encoding ever changes
+
+
+def encode(datastring, compress=True, level=6):
+    if not compress or datastring is None:
+        return datastring
+    return PREFIX + base64.b64encode(zlib.compress(datastring.encode('utf-8'), level)).decode('ascii')
+
+
+def decode(stored):
+    # a corrupt row raises ValueError, just like a corrupt plain JSON row would
+    # when it's parsed, so callers only have one thing to catch
+    if stored is None or not stored.startswith(PREFIX):
+        return stored
+    try:
+        return zlib.decompress(base64.b64decode(stored[len(PREFIX):])).decode('utf-8')
+    except (zlib.error, binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f'could not decode compressed datastring: {e}')
+
+
+def is_compressed(stored):
+    return stored is not None and stored.startswith(PREFIX)
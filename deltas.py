@@ -0,0 +1,70 @@
+# Incremental saves from /sync_delta (see custom.py), one row per save.
+#
+# Rewriting the participant's whole datastring on every save gets slower as
+# the session goes on, so each save is appended here instead, numbered by seq
+# within the participant. The full datastring is the participant's stored
+# datastring with their rows applied in order (assemble). When the experiment
+# is completed, the rows are folded into the datastring once, leaving a single
+# checkpoint row (delta is None) that only carries the counts and aggregates.
+#
+# data_end and eventdata_end are the number of records the server has after
+# the row is applied, and aggregates is the JSON of the running aggregates at
+# that point, so a save only needs the participant's last row.
+#
+# Used by custom.py and bin/fetch_data.py.
+
+from collections import defaultdict
+from json import loads
+
+from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy.orm import deferred, undefer
+
+from psiturk.models import Base, ASSIGNMENTS_TABLENAME
+import datastore
+
+APPENDED_KEYS = ['data', 'eventdata']
+
+
+class Delta(Base):
+    __tablename__ = ASSIGNMENTS_TABLENAME + '_deltas'
+
+    uniqueid = Column(String(128), primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    data_end = Column(Integer, nullable=False)
+    eventdata_end = Column(Integer, nullable=False)
+    aggregates = Column(Text, nullable=False)
+    delta = deferred(Column(Text))  # encoded like the datastring (see datastore.py)
+
+    def counts(self):
+        return {key: getattr(self, key + '_end') for key in APPENDED_KEYS}
+
+
+def latest(uniqueid):
+    return (Delta.query.filter(Delta.uniqueid == uniqueid)
+            .order_by(Delta.seq.desc()).first())
+
+
+def load(uniqueids):
+    """Rows (with their deltas) for each of uniqueids, in order."""
+    rows = defaultdict(list)
+    if uniqueids:
+        query = (Delta.query.filter(Delta.uniqueid.in_(list(uniqueids)))
+                 .options(undefer(Delta.delta))
+                 .order_by(Delta.uniqueid, Delta.seq))
+        for row in query:
+            rows[row.uniqueid].append(row)
+    return rows
+
+
+def assemble(data, rows):
+    """Apply rows (from load) to the decoded datastring data, in place."""
+    for row in rows:
+        if row.delta is None:
+            continue
+        delta = loads(datastore.decode(row.delta))
+        for key in APPENDED_KEYS:
+            data.setdefault(key, []).extend(delta.pop(key, []))
+        data.update(delta)
+    if rows:
+        data['aggregates'] = loads(rows[-1].aggregates)
+    return data
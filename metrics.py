@@ -0,0 +1,77 @@
+# Request metrics, recorded by custom.py and served at /metrics in the
+# Prometheus text format.
+#
+# Each server worker process (see threads in config.txt) keeps its own
+# numbers, so every series has a worker label. A scrape only reaches one
+# worker; sum over the label across scrapes to get totals.
+
+import os
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)  # (method, route, status) -> count
+        self.duration = defaultdict(lambda: [0] * (len(buckets) + 1))  # (method, route) -> count per bucket (last is +Inf)
+        self.duration_sum = defaultdict(float)
+        self.request_bytes = defaultdict(int)
+        self.response_bytes = defaultdict(int)
+        self.db_queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+
+    def observe(self, method, route, status, seconds, request_bytes=0, response_bytes=0, db_queries=0, db_seconds=0):
+        key = (method, route)
+        with self.lock:
+            self.requests[key + (str(status),)] += 1
+            self.duration[key][bisect_left(self.buckets, seconds)] += 1
+            self.duration_sum[key] += seconds
+            self.request_bytes[key] += request_bytes
+            self.response_bytes[key] += response_bytes
+            self.db_queries[key] += db_queries
+            self.db_seconds[key] += db_seconds
+
+    def render(self):
+        worker = str(os.getpid())
+        lines = []
+        def metric(name, kind, help):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+        def sample(name, value, **labels):
+            labels = ','.join(f'{k}="{escape(v)}"' for k, v in dict(labels, worker=worker).items())
+            lines.append(f'{name}{{{labels}}} {value}')
+
+        with self.lock:
+            metric('http_requests_total', 'counter', 'Requests handled, by route and status.')
+            for (method, route, status), n in sorted(self.requests.items()):
+                sample('http_requests_total', n, method=method, route=route, status=status)
+
+            metric('http_request_duration_seconds', 'histogram', 'Time from the start of a request to the end of its response body.')
+            for (method, route), counts in sorted(self.duration.items()):
+                total = 0
+                for le, n in zip(self.buckets + ('+Inf',), counts):
+                    total += n
+                    sample('http_request_duration_seconds_bucket', total, method=method, route=route, le=str(le))
+                sample('http_request_duration_seconds_sum', round(self.duration_sum[method, route], 6), method=method, route=route)
+                sample('http_request_duration_seconds_count', total, method=method, route=route)
+
+            for name, values, help in [
+                ('http_request_bytes_total', self.request_bytes, 'Bytes received in request bodies (as sent, e.g. gzipped).'),
+                ('http_response_bytes_total', self.response_bytes, 'Bytes sent in response bodies.'),
+                ('db_queries_total', self.db_queries, 'SQL statements executed while handling requests.'),
+                ('db_query_seconds_total', self.db_seconds, 'Time spent executing SQL statements while handling requests.'),
+            ]:
+                metric(name, 'counter', help)
+                for (method, route), value in sorted(values.items()):
+                    sample(name, round(value, 6), method=method, route=route)
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -27,7 +27,7 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
      * TASK DATA    *
      ***************/
     var TaskData = Backbone.Model.extend({
-        urlRoot: "/sync", // Fetch will GET from this url, while Save will PUT to this url, with mimetype 'application/JSON'
+        urlRoot: "/sync_delta", // Fetch will GET from this url; saveData PUTs only new records here (see custom.py)
         id: uniqueId,
         adServerLoc: adServerLoc,
         mode: mode,
@@ -259,9 +259,55 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
                 });
     };
     
-    // Save data to server
+    // Resolves to the gzipped text, or null if the browser can't do it (or
+    // it isn't worth it). Small saves are sent as they are.
+    var gzip = function(text) {
+        if (!window.CompressionStream || text.length < 1024) return Promise.resolve(null);
+        var stream = new Blob([text]).stream().pipeThrough(new CompressionStream("gzip"));
+        return new Response(stream).arrayBuffer().catch(function() { return null; });
+    };
+
+    // Save data to server. Only the trials and events recorded since the last
+    // acknowledged save are sent, along with the index of the first one.
+    // callbacks.sent is called when the request goes out (after gzipping).
+    // Pass sync: true to send right away, uncompressed (e.g. when the page is
+    // about to unload and wouldn't wait for gzip to finish).
     self.saveData = function(callbacks) {
-        taskdata.save(undefined, callbacks);
+        callbacks = callbacks || {};
+        var payload = _.omit(taskdata.toJSON(), 'data', 'eventdata');
+        _.each(synced, function(start, key) {
+            payload[key] = taskdata.get(key).slice(start);
+            payload[key + 'Start'] = start;
+        });
+        var body = JSON.stringify(payload);
+        var send = function(compressed) {
+            if (callbacks.sent) callbacks.sent();
+            $.ajax(taskdata.url(), {
+                type: "PUT",
+                contentType: "application/json",
+                data: compressed || body,
+                processData: false,
+                headers: compressed ? {"Content-Encoding": "gzip"} : {},
+                success: function(resp) {
+                    synced = {data: resp.data, eventdata: resp.eventdata};
+                    if (callbacks.success) callbacks.success(resp);
+                },
+                error: function(xhr) {
+                    if (xhr.status == 409 && xhr.responseJSON && !callbacks.retried) {
+                        // the server is missing records we thought it had; resend from there
+                        synced = {data: xhr.responseJSON.data, eventdata: xhr.responseJSON.eventdata};
+                        self.saveData(_.extend({}, callbacks, {retried: true}));
+                    } else if (callbacks.error) {
+                        callbacks.error(xhr);
+                    }
+                }
+            });
+        };
+        if (callbacks.sync) {
+            send(null);
+        } else {
+            gzip(body).then(send);
+        }
     };
 
     self.startTask = function () {
@@ -275,7 +321,7 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
         if (self.taskdata.mode != 'debug') {  // don't block people from reloading in debug mode
             // Provide opt-out 
             $(window).on("beforeunload", function(){
-                self.saveData();
+                self.saveData({sync: true});
                 
                 $.ajax("quitter", {
                         type: "POST",
@@ -323,7 +369,11 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
     /* initialized local variables */
 
     var taskdata = new TaskData();
-    taskdata.fetch({async: false});
+    // number of trials/events the server already has
+    var synced = {data: 0, eventdata: 0};
+    taskdata.fetch({async: false, success: function(model, resp) {
+        synced = {data: (resp.data || []).length, eventdata: (resp.eventdata || []).length};
+    }});
     
     /*  DATA: */
     self.pages = {};
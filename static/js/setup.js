@@ -138,14 +138,14 @@ const DATA = {
     }
 
     this.recordEvent('data.attempt')
-    const promise = new Promise((resolve) => {
+    let result = await new Promise((resolve) => {
       psiturk.saveData({
+        // the timeout starts when the request is sent, not while it's being gzipped
+        sent: () => sleep(10000, 'timeout').then(resolve),
         error: () => resolve("error"),
         success: () => resolve("success")
       })
     })
-
-    let result = await Promise.race([promise, sleep(10000, 'timeout')])
     if (result == "success") {
       this.recordEvent("data.success")
       return "success"